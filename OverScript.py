@@ -23,6 +23,9 @@ import pathlib
 import argparse
 import logging
 import os
+import time
+import json
+import concurrent.futures
 
 SUFFIX_INPUT = (".os", ".py", ".pyos")
 SUFFIX_OUTPUT = (".ows",) #winner of the great 2019 overwatch workshop rule file extension vote (not representative)
@@ -33,37 +36,381 @@ log_levels = {
     2: logging.DEBUG
     }
 
-from compiler import OverScriptCompiler
-
 parser = argparse.ArgumentParser(description="CLI for the OverScript compiler")
 parser.add_argument("-v", "--verbose", action="count", default=0, help="Set logging level")
 parser.add_argument("-o", "--out", action="store", help="Set output file path")
-parser.add_argument("-O", "--optimize", action="store_true", help="optimize output")
+parser.add_argument("-O", "--optimize", action="count", default=0, help="optimize output, repeat to unroll larger loops")
 parser.add_argument("-g", "--guess", action="store_true", help="attempt to guess unknown functions instead of raising error")
 parser.add_argument("-c", "--correct-accents", action="store_true", help="use text filters to correct common misspellings of string literals")
-parser.add_argument("source", nargs="+")
-
-args = parser.parse_args()
-if args.verbose in log_levels:
-    logging.basicConfig(level=log_levels[args.verbose])
-else:
-    logging.basicConfig(level=logging.DEBUG)
-
-p_in = args.source
-compiler = OverScriptCompiler(optimize=args.optimize, parseUnknownFunctions=args.guess, correctAccents=args.correct_accents)
-for i in p_in:
-    path = pathlib.Path(i)
-    if not path.exists():
-        logging.error("File '%s' does not exist, skipping..." % str(path))
-        continue
+parser.add_argument("--native-loops", action="store_true", help="compile loops to While and End actions instead of Loop and Skip")
+parser.add_argument("--subroutines", action="store_true", help="compile utility functions called from several places to subroutines")
+parser.add_argument("-j", "--jobs", action="store", type=int, default=1, help="number of files to compile in parallel (0 uses all CPUs)")
+parser.add_argument("--stats", action="store_true", help="print element, action, condition and variable counts of every rule")
+parser.add_argument("--stats-json", action="store", metavar="FILE", help="write the statistics of all compiled files to FILE as JSON")
+parser.add_argument("--max-elements", action="store", type=int, metavar="N", help="fail if a script uses more than N workshop elements")
+parser.add_argument("--profile", action="store_true", help="print wall time and call counts of every compiler phase")
+parser.add_argument("--profile-trace", action="store", metavar="FILE", help="write a trace of all compiler phases to FILE (for chrome://tracing)")
+parser.add_argument("--timings", action="store_true", help="print a breakdown of where time was spent")
+parser.add_argument("--no-cache", action="store_true", help="always compile, don't use or update the compile cache")
+parser.add_argument("--cache-dir", action="store", default=".oscache", help="Set compile cache directory")
+parser.add_argument("--cache-size", action="store", type=int, default=32, help="maximum size of the compile cache in MiB")
+parser.add_argument("--cache-stats", action="store_true", help="print compile cache statistics")
+parser.add_argument("-w", "--watch", action="store", metavar="DIR", help="keep running and recompile scripts in DIR whenever they change")
+parser.add_argument("--interval", action="store", type=float, default=0.5, help="Set polling interval for --watch in seconds")
+parser.add_argument("source", nargs="*")
+
+def output_path(path, args):
+
+    """
+    Returns the path of the compiled file for the source file at path.
+    """
+
     if args.out:
         target = pathlib.Path(args.out)
         os.makedirs(target, exist_ok=True)
     else:
         target = path.parent
     filename = path.stem + SUFFIX_OUTPUT[0]
-    p = target / filename
-    logging.info("Compiling file '%s'..." % str(path))
-    with open(path, "r") as file_in:
-        with open(p, "w") as file_out:
-            file_out.write(compiler.compile(file_in.read()))
\ No newline at end of file
+    return target / filename
+
+def print_timings(timings):
+
+    """
+    Print a list of (phase, seconds) tuples as a table.
+    """
+
+    print("Timings:", file=sys.stderr)
+    for phase, t in timings:
+        print("    %-28s %10.3f ms" % (phase, t * 1000), file=sys.stderr)
+    print("    %-28s %10.3f ms" % ("total", sum(map(lambda x: x[1], timings)) * 1000), file=sys.stderr)
+
+def print_stats(path, stats):
+
+    """
+    Print the statistics of a compiled script as a table.
+    """
+
+    def row(name, entry):
+        variables = entry["variables"]
+        slots = entry["slots"]
+        print("    %-28s %10i %8i %10i %5i/%-5i %5i/%-5i" % (name[:28], entry["elements"], entry["actions"], entry["conditions"],
+            len(variables["global"]), len(variables["player"]), len(slots["global"]), len(slots["player"])), file=sys.stderr)
+
+    print("Statistics for '%s':" % str(path), file=sys.stderr)
+    print("    %-28s %10s %8s %10s %11s %11s" % ("rule", "elements", "actions", "conditions", "variables", "slots"), file=sys.stderr)
+    for rule in stats["rules"]:
+        row(rule["name"], rule)
+    row("total", stats)
+
+def print_profile(profiler):
+
+    """
+    Print the phase totals recorded by a profiler as a table.
+    """
+
+    print("Profile:", file=sys.stderr)
+    print("    %-40s %8s %12s %12s" % ("phase", "calls", "total", "per call"), file=sys.stderr)
+    for phase, calls, seconds in profiler.totals():
+        print("    %-40s %8i %9.3f ms %9.3f ms" % (phase[:40], calls, seconds * 1000, seconds * 1000 / calls), file=sys.stderr)
+
+def compiler_options(args):
+
+    """
+    Returns the keyword arguments for creating a compiler from the command line arguments.
+    """
+
+    return {
+        "optimize": args.optimize,
+        "parseUnknownFunctions": args.guess,
+        "correctAccents": args.correct_accents,
+        #explicit, so workshop.json is still only loaded for unknown functions
+        "nativeLoops": args.native_loops,
+        "subroutines": args.subroutines,
+        "maxElements": args.max_elements
+        }
+
+def create_cache(args):
+
+    """
+    Create the compile cache for the command line arguments.
+    Cache keys cover the compiler options, the string template list,
+    workshop.json and the compiler version.
+    """
+
+    import compile_cache
+
+    environment = ["%s=%r" % item for item in sorted(compiler_options(args).items())]
+    environment.append("strings=%s" % compile_cache.file_digest("res/strings.txt"))
+    environment.append("workshop=%s" % compile_cache.file_digest("res/workshop.json"))
+    environment.append("compiler=%s" % compile_cache.compiler_digest())
+    return compile_cache.CompileCache(args.cache_dir, args.cache_size * 1024 * 1024, environment)
+
+def print_cache_stats(stats):
+
+    """
+    Print the statistics of a compile cache.
+    """
+
+    print("Compile cache '%s':" % stats["directory"], file=sys.stderr)
+    print("    %-28s %10i" % ("hits", stats["hits"]), file=sys.stderr)
+    print("    %-28s %10i" % ("misses", stats["misses"]), file=sys.stderr)
+    print("    %-28s %10i" % ("evictions", stats["evictions"]), file=sys.stderr)
+    print("    %-28s %10i" % ("entries", stats["entries"]), file=sys.stderr)
+    print("    %-28s %10.1f KiB / %.1f KiB" % ("size", stats["size"] / 1024, stats["max_size"] / 1024), file=sys.stderr)
+
+def compile_file(compiler, path, target, stats=False):
+
+    """
+    Compile the source file at path and write the result to target.
+    Returns a tuple (error, durations, stats). error is None if the file was
+    compiled successfully and a message describing the problem otherwise.
+    durations holds the time spent reading, compiling and writing the file.
+    If stats is True, stats holds the statistics of the compiled script,
+    otherwise it is None.
+    """
+
+    read_time = compile_time = write_time = 0
+    result = None
+    try:
+        start = time.perf_counter()
+        with open(path, "r") as file_in:
+            source = file_in.read()
+        t = time.perf_counter()
+        read_time = t - start
+        code = compiler.compile(source)
+        start = time.perf_counter()
+        compile_time = start - t
+        with open(target, "w") as file_out:
+            file_out.write(code)
+        write_time = time.perf_counter() - start
+        if stats:
+            result = compiler.stats()
+    except Exception as e:
+        logging.debug("Compilation of '%s' failed:" % str(path), exc_info=True)
+        return "%s: %s" % (e.__class__.__name__, e), (read_time, compile_time, write_time), None
+    return None, (read_time, compile_time, write_time), result
+
+#Compiler instance of a worker process, see init_worker()
+_worker_compiler = None
+
+def init_worker(options, level):
+
+    """
+    Set up a worker process for parallel compilation.
+    Each worker holds its own compiler with the string template database
+    and workshop.json already loaded, so no file pays for loading them.
+    """
+
+    global _worker_compiler
+
+    logging.basicConfig(level=level)
+    from compiler import OverScriptCompiler
+    _worker_compiler = OverScriptCompiler(**options)
+    _worker_compiler.stringParser
+    _worker_compiler.workshop_functions
+
+def compile_file_worker(path, target, stats):
+
+    return compile_file(_worker_compiler, path, target, stats)
+
+def scan_sources(directory):
+
+    """
+    Find all OverScript files in directory and its subdirectories.
+    Returns a dictionary mapping each path to its modification time and size.
+    """
+
+    sources = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = filter(lambda x: not x.startswith("."), dirs)
+        for name in files:
+            path = pathlib.Path(root, name)
+            if path.suffix not in SUFFIX_INPUT:
+                continue
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            sources[path] = (stat.st_mtime_ns, stat.st_size)
+    return sources
+
+def watch(args):
+
+    """
+    Watch a directory for changes and recompile changed files
+    until interrupted.
+
+    A single compiler is kept for the entire session, so the string
+    template database and workshop.json are only loaded once.
+    Files are recompiled on startup if their output is missing or outdated.
+    """
+
+    from compiler import OverScriptCompiler
+    compiler = OverScriptCompiler(**compiler_options(args))
+    compiler.stringParser
+    compiler.workshop_functions
+
+    def build(path):
+        target = output_path(path, args)
+        error, durations, stats = compile_file(compiler, path, target)
+        if error is not None:
+            print("Failed to compile '%s': %s" % (str(path), error))
+        else:
+            print("Compiled '%s' in %.1f ms" % (str(path), sum(durations) * 1000))
+
+    known = scan_sources(args.watch)
+    for path in sorted(known):
+        target = output_path(path, args)
+        if not target.exists() or target.stat().st_mtime_ns < known[path][0]:
+            build(path)
+
+    print("Watching '%s' for changes, press Ctrl+C to stop..." % args.watch)
+    try:
+        while True:
+            time.sleep(args.interval)
+            current = scan_sources(args.watch)
+            for path in sorted(current):
+                if known.get(path) != current[path]:
+                    build(path)
+            known = current
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def main():
+
+    args = parser.parse_args()
+    level = log_levels.get(args.verbose, logging.DEBUG)
+    logging.basicConfig(level=level)
+
+    if args.watch:
+        if not os.path.isdir(args.watch):
+            parser.error("'%s' is not a directory" % args.watch)
+        return watch(args)
+    if not args.source:
+        parser.error("the following arguments are required: source")
+
+    timings = []
+    def phase(name, start):
+        t = time.perf_counter()
+        timings.append((name, t - start))
+        return t
+
+    failures = []
+    paths = []
+    targets = []
+    for i in args.source:
+        path = pathlib.Path(i)
+        if not path.exists():
+            logging.error("File '%s' does not exist, skipping..." % str(path))
+            failures.append(path)
+            continue
+        paths.append(path)
+        targets.append(output_path(path, args))
+
+    #statistics are taken from the compiled rules, so files are always compiled if they are requested
+    want_stats = args.stats or args.stats_json is not None
+    profiling = args.profile or args.profile_trace is not None
+
+    #copy files that didn't change from the cache
+    keys = {}
+    if not args.no_cache:
+        start = time.perf_counter()
+        cache = create_cache(args)
+        remaining = []
+        for path, target in zip(paths, targets):
+            with open(path, "rb") as f:
+                key = cache.key(f.read())
+            if not (want_stats or profiling) and cache.get(key, target):
+                logging.info("File '%s' is unchanged, using cached output." % str(path))
+            else:
+                keys[path] = key
+                remaining.append((path, target))
+        paths = list(map(lambda x: x[0], remaining))
+        targets = list(map(lambda x: x[1], remaining))
+        phase("check compile cache", start)
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    jobs = min(jobs, len(paths))
+    if profiling and jobs > 1:
+        logging.info("Profiling, compiling files in a single process...")
+        jobs = 1
+
+    if not paths:
+        results = []
+    elif jobs > 1:
+        start = time.perf_counter()
+        logging.info("Compiling %i files using %i processes..." % (len(paths), jobs))
+        with concurrent.futures.ProcessPoolExecutor(jobs, initializer=init_worker, initargs=(compiler_options(args), level)) as pool:
+            results = list(pool.map(compile_file_worker, paths, targets, [want_stats] * len(paths)))
+        phase("compile (%i processes)" % jobs, start)
+    else:
+        #The compiler is only imported once the arguments have been validated.
+        #It loads its string template database and workshop.json lazily, when
+        #the first script that needs them is compiled.
+        start = time.perf_counter()
+        from compiler import OverScriptCompiler
+        start = phase("import compiler", start)
+        compiler = OverScriptCompiler(**compiler_options(args))
+        start = phase("create compiler", start)
+        if profiling:
+            import profiler
+            profile = profiler.Profiler()
+            compiler.addProfileHook(profile)
+
+        results = []
+        for path, target in zip(paths, targets):
+            logging.info("Compiling file '%s'..." % str(path))
+            if profiling:
+                profile.context = str(path)
+            results.append(compile_file(compiler, path, target, want_stats))
+
+        read_time = compile_time = write_time = 0
+        for error, (r, c, w), stats in results:
+            read_time += r
+            compile_time += c
+            write_time += w
+        #lazy loads happen during compilation, report them separately
+        for name, t in compiler.loadTimes.items():
+            timings.append(("load %s" % name, t))
+            compile_time -= t
+        timings.append(("read sources", read_time))
+        timings.append(("compile", compile_time))
+        timings.append(("write output", write_time))
+
+    #report errors in the order the files were passed in
+    all_stats = {}
+    for path, target, (error, durations, stats) in zip(paths, targets, results):
+        if error is not None:
+            logging.error("Failed to compile '%s': %s" % (str(path), error))
+            failures.append(path)
+            continue
+        if path in keys:
+            cache.put(keys[path], target)
+        if stats is not None:
+            all_stats[str(path)] = stats
+            if args.stats:
+                print_stats(path, stats)
+
+    if args.stats_json is not None:
+        with open(args.stats_json, "w") as f:
+            json.dump(all_stats, f, indent=4)
+
+    if paths and profiling:
+        if args.profile:
+            print_profile(profile)
+        if args.profile_trace is not None:
+            with open(args.profile_trace, "w") as f:
+                json.dump(profile.trace(), f)
+    if args.timings:
+        print_timings(timings)
+    if args.cache_stats and not args.no_cache:
+        print_cache_stats(cache.stats())
+
+    if failures:
+        logging.error("%i of %i files failed to compile." % (len(failures), len(args.source)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+#Content addressed cache for compiled OverScript files
+#
+#Compiled scripts are stored under a key derived from everything that
+#influences the compiler output: the source code, the compiler options,
+#the string template list, workshop.json and the compiler itself.
+#If none of these changed, the compiled script can simply be copied from
+#the cache instead of compiling the source again.
+
+#Copyright (c) 2019 fredi_68
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import hashlib
+import logging
+import os
+import pathlib
+import shutil
+
+DEFAULT_DIRECTORY = ".oscache"
+DEFAULT_MAX_SIZE = 32 * 1024 * 1024
+
+ENTRY_SUFFIX = ".ows"
+
+#Modules the compiler is made of, their source determines its output
+COMPILER_MODULES = ("compiler", "ir", "optimizer", "owwlib", "string_parser", "workshop_index")
+
+logger = logging.getLogger("OS.CompileCache")
+
+def file_digest(path):
+
+    """
+    Returns the SHA-1 of the file at path or None if it doesn't exist.
+    """
+
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def compiler_digest():
+
+    """
+    Returns a digest identifying the version of the compiler.
+    This covers the source of every module of the compiler (see COMPILER_MODULES),
+    so any change to it invalidates all cached files. Changes to other scripts
+    such as the test and benchmark runners don't.
+    """
+
+    h = hashlib.sha1()
+    directory = pathlib.Path(__file__).parent
+    for path in sorted(directory / (module + ".py") for module in COMPILER_MODULES):
+        h.update(path.name.encode("utf-8"))
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+class CompileCache():
+
+    """
+    On-disk cache of compiled scripts.
+
+    Every entry is a single file named after its key. When the total size
+    of all entries exceeds max_size, the least recently used entries are
+    evicted. The modification time of an entry is used as its last access time.
+    The total size is only scanned once and then kept up to date as entries are
+    stored, so the directory is only scanned again when entries must be evicted.
+    """
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size=DEFAULT_MAX_SIZE, environment=()):
+
+        """
+        Create a new cache in directory.
+        environment should be a sequence of strings describing the
+        compiler setup (options, database digests, compiler version),
+        which are made part of every key.
+        """
+
+        self.directory = pathlib.Path(directory)
+        self.max_size = max_size
+        self.environment = "\n".join(map(str, environment))
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None #total size of all entries, None until scanned
+
+    def key(self, source):
+
+        """
+        Returns the key for the source code source, given as bytes.
+        """
+
+        h = hashlib.sha256(self.environment.encode("utf-8"))
+        h.update(b"\0")
+        h.update(source)
+        return h.hexdigest()
+
+    def _path(self, key):
+
+        return self.directory / (key + ENTRY_SUFFIX)
+
+    def get(self, key, target):
+
+        """
+        Copy the entry for key to target.
+        Returns True on a cache hit and False otherwise.
+        """
+
+        path = self._path(key)
+        try:
+            shutil.copyfile(path, target)
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, key, source):
+
+        """
+        Store a copy of the compiled file at source as the entry for key.
+        Failing to store the entry is not an error.
+        """
+
+        path = self._path(key)
+        temp_path = path.with_name("%s.%i.tmp" % (path.name, os.getpid()))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            shutil.copyfile(source, temp_path)
+            size = os.path.getsize(temp_path)
+            try:
+                replaced = os.path.getsize(path)
+            except OSError:
+                replaced = 0
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.debug("Unable to store cache entry '%s': %s", path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            return
+        if self._size is None:
+            self._size = sum(map(lambda x: x[1], self.entries()))
+        else:
+            self._size += size - replaced
+        if self._size > self.max_size:
+            self.evict()
+
+    def entries(self):
+
+        """
+        Returns a list of (last access, size, path) tuples for all entries.
+        """
+
+        entries = []
+        try:
+            it = os.scandir(self.directory)
+        except OSError:
+            return entries
+        with it:
+            for entry in it:
+                if not entry.name.endswith(ENTRY_SUFFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+
+        """
+        Remove the least recently used entries until the cache fits into max_size.
+        """
+
+        entries = self.entries()
+        size = sum(map(lambda x: x[1], entries))
+        self._size = size
+        if size <= self.max_size:
+            return
+        entries.sort()
+        for atime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self._size = size
+            self.evictions += 1
+            logger.debug("Evicted cache entry '%s'.", path)
+
+    def stats(self):
+
+        """
+        Returns a dictionary describing the state of the cache.
+        """
+
+        entries = self.entries()
+        return {
+            "directory": str(self.directory),
+            "entries": len(entries),
+            "size": sum(map(lambda x: x[1], entries)),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+            }
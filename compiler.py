@@ -22,11 +22,14 @@
 
 
 import ast
+import collections
+import contextlib
 import logging
-import json
+import time
 
+import ir
+import optimizer
 import owwlib
-from string_parser import StringParser
 
 EVENTS = {
     "player": "Ongoing - Each Player",
@@ -47,6 +50,20 @@ OPERATORS = {
     "GtE": ">="
     }
 
+BINARY_OPERATORS = {
+    ast.Add: "Add",
+    ast.Sub: "Subtract",
+    ast.Mult: "Multiply",
+    ast.Div: "Divide",
+    ast.Mod: "Modulo",
+    ast.Pow: "Raise To Power",
+    ast.And: "And",
+    ast.Or: "Or"
+    }
+
+#Context manager used for phases while no profiling hooks are registered
+NO_PHASE = contextlib.nullcontext()
+
 class FunctionReturned(Exception):
 
     """
@@ -57,6 +74,21 @@ class FunctionReturned(Exception):
         self.value = value
         return super().__init__()
 
+class ReturnTarget():
+
+    """
+    Target of the return statements inside of blocks
+    of a utility function being parsed
+    """
+
+    def __init__(self, name):
+        self.name = name #variable storing the value returned
+        self.label = ir.Label("return")
+        self.depth = 0 #number of blocks the parser is in
+        self.loops = 0 #number of loops the parser is in
+        self.used = False
+        self.hasValue = False
+
 class TOS():
 
     """
@@ -72,6 +104,10 @@ class Rule():
 
     """
     Dataclass for Overwatch Workshop rules
+
+    conditions is a list of ir.Condition nodes, actions is a list
+    of ir.Action and ir.Label nodes. entry is the label marking the
+    first action of the rule body, loop branch targets are relative to it.
     """
 
     def __init__(self, name, events, docstring=""):
@@ -90,23 +126,67 @@ class Rule():
         self.docstring = docstring
         self.events = events
         self.conditions = []
-        self.actions = []
+        self.entry = ir.Label("entry")
+        self.actions = [self.entry]
         self.lastLoopBranch = 0
         self.loopCount = 0
+        self.loopCounters = [] #loop iteration slots, by nesting depth
+        self.loopDepth = 0
 
     def isGlobal(self):
 
         """
         Check whether or not this rule uses global or player specific events.
+        Subroutines may be called by any rule, so they count as global.
+        """
+
+        return self.events[0] in (EVENTS["global"], "Subroutine")
+
+    def elements(self):
+
+        """
+        Returns the number of workshop elements used by the conditions and actions of this rule.
+        """
+
+        return sum(node.elements() for node in self.conditions) + sum(action.elements() for action in self.actions)
+
+    def stats(self):
+
         """
+        Returns a dictionary describing the size of this rule.
+        variables holds the workshop variables accessed by the rule and slots
+        the indices of the variable array (A) used, global and player specific
+        ones separately.
+        """
+
+        variables = {True: set(), False: set()}
+        slots = {True: set(), False: set()}
+        stack = list(self.conditions) + self.actions
+        while stack:
+            node = stack.pop()
+            cls = node.__class__
+            if cls is ir.Variable or cls is ir.SetVariable or cls is ir.ModifyVariable:
+                isGlobal = node.player is None
+                variables[isGlobal].add(node.var)
+                if node.var == OverScriptCompiler.VS_VAR and node.index is not None:
+                    slots[isGlobal].add(node.index)
+            stack.extend(node.children())
 
-        return self.events[0] == EVENTS["global"]
+        return {
+            "name": self.name,
+            "events": list(self.events),
+            "elements": self.elements(),
+            "actions": sum(1 for action in self.actions if action.__class__ is not ir.Label),
+            "conditions": len(self.conditions),
+            "variables": {"global": sorted(variables[True]), "player": sorted(variables[False])},
+            "slots": {"global": sorted(slots[True]), "player": sorted(slots[False])}
+            }
 
     def __str__(self):
 
         events = """\tevent\n\t{\n\t\t%s\n\t}\n""" % "\n\t\t".join(map(lambda x: x.title()+";", self.events))
-        conditions = """\tconditions\n\t{\n\t\t%s\n\t}\n""" % "\n\t\t".join(map(lambda x: x+";", self.conditions))
-        actions = """\tactions\n\t{\n\t\t%s\n\t}\n""" % "\n\t\t".join(map(lambda x: x, self.actions))
+        conditions = """\tconditions\n\t{\n\t\t%s\n\t}\n""" % "\n\t\t".join(map(lambda x: str(x)+";", self.conditions))
+        actions = """\tactions\n\t{\n\t\t%s\n\t}\n""" % "\n\t\t".join(ir.serialize(self.actions))
 
         docstring = ""
         if self.docstring:
@@ -140,22 +220,79 @@ class OverScriptCompiler():
 
         A - [Array] Variables
         B - [Array] Loop branch state
-        C - [Array] Loop iteration state
+        C - [Array] Loop iteration counters
         D - [Array] Array assembly stack
         E - Array assembly source
         F - Array assembly target
+        G - Common subexpression scratch
+
+    Nested arrays are assembled in D, E and F, depending on how deeply
+    they are nested.
+    All other workshop variables are given to the most frequently
+    used variables, which are then no longer stored in A.
     """
 
+    #All workshop variables
+    VARIABLES = tuple("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+
     VS_VAR = "A"
     VS_LBS = "B"
     VS_LIS = "C"
     VS_AAS = "D"
     VS_ASR = "E"
     VS_AAT = "F"
+    VS_CSE = "G"
+
+    #Variables nested arrays are assembled in, by height starting at 2
+    ARRAY_ASSEMBLY_VARS = (VS_AAS, VS_ASR, VS_AAT)
+
+    #Handlers for AST nodes, by node class.
+    #Each table maps a node class to the name of the method handling it,
+    #subclasses may extend these tables to support additional node types.
+    BODY_HANDLERS = {
+        ast.Assign: "_parseAssign",
+        ast.While: "_parseWhile",
+        ast.If: "_parseIf",
+        ast.Expr: "_parseExprStatement",
+        ast.AugAssign: "_parseAugAssign",
+        ast.For: "_parseFor",
+        ast.Return: "_parseReturn"
+        }
+    EXPR_HANDLERS = {
+        ast.Call: "_parseCall",
+        ast.Name: "_parseName",
+        ast.Subscript: "_parseSubscript",
+        ast.List: "_parseArray",
+        ast.Tuple: "_parseArray",
+        ast.BinOp: "_parseBinaryOp",
+        ast.Compare: "_parseCompare",
+        ast.Attribute: "_parseAttribute"
+        }
+    BINARY_OPERATOR_HANDLERS = {
+        ast.LShift: "_parseStringFormat"
+        }
+    #Optimization passes run on all rules, in order.
+    #See optimizer.py for how passes work.
+    OPTIMIZATION_PASSES = (
+        optimizer.eliminateDeadCode,
+        optimizer.allocateRegisters,
+        optimizer.eliminateCommonSubexpressions,
+        optimizer.optimizePeephole,
+        )
+    #Largest for loops over constant arrays which are unrolled, by optimization level.
+    #Each entry holds the maximum number of iterations and the maximum number
+    #of elements the unrolled loop may use.
+    UNROLL_BUDGETS = ((4, 64), (16, 256), (64, 1024))
+    #Smallest constant arrays which are stored in a variable once
+    #instead of being built wherever they are used
+    TABLE_MIN_LENGTH = 4
+    #Largest utility functions which are always inlined, in elements.
+    #Larger ones are compiled to subroutines if they are called from several places.
+    INLINE_MAX_ELEMENTS = 24
 
     logger = logging.getLogger("OSCompiler")
 
-    def __init__(self, optimize=False, parseUnknownFunctions=False, correctAccents=True):
+    def __init__(self, optimize=False, parseUnknownFunctions=False, correctAccents=True, nativeLoops=None, subroutines=None, maxElements=None):
 
         """
         Create a new compiler instance.
@@ -163,7 +300,7 @@ class OverScriptCompiler():
         optimize controls the level of output space optimization performed by the compiler.
             The compiler always uses all code optimizations available, but many things such as
             comments or additional linebreaks and spaces for better readability may be omitted
-            if optimize=False.
+            if optimize=False. Higher levels (2, 3) unroll larger loops, see UNROLL_BUDGETS.
         parseUnknownFunctions determines how the compiler handles unknown function signatures.
             If set to False, any unknown function call raises an exception. If set to True,
             the compiler instead assumes that the function exists on the workshop instead and
@@ -172,40 +309,111 @@ class OverScriptCompiler():
         correctAccents controls the use of input filters that transform commonly used synonyms
             of literals to their correct spelling. For example, "Lucio" will be turned into
             "Lúcio". If this option is set to False, filters will log a warning instead.
+        nativeLoops controls how loops are compiled. If set to True, loops use the While and
+            End actions of the workshop. If set to False, they are built from Loop and Skip
+            actions, which requires a short delay at the start of every rule containing a loop.
+            If set to None, While and End are used if they are listed in workshop.json.
+        subroutines controls whether utility functions called from several places may be
+            compiled to subroutines instead of being inlined at every call. If set to None,
+            subroutines are used if Call Subroutine is listed in workshop.json.
+        maxElements if not None, is the largest number of workshop elements the compiled
+            script may use. Scripts exceeding it raise an exception instead of being compiled.
         """
 
         self.optimize = optimize
         self.parseUnknownFunctions = parseUnknownFunctions
         self.correctAccents = correctAccents
-        self.used_vars = (self.VS_VAR, self.VS_LBS, self.VS_LIS, self.VS_AAS, self.VS_ASR, self.VS_AAT)
+        self.nativeLoops = nativeLoops
+        self.subroutines = subroutines
+        self.maxElements = maxElements
+        self.used_vars = (self.VS_VAR, self.VS_LBS, self.VS_LIS, self.VS_AAS, self.VS_ASR, self.VS_AAT, self.VS_CSE)
+
+        #resolve handler tables to bound methods once
+        self._bodyHandlers = self._bindHandlers(self.BODY_HANDLERS)
+        self._exprHandlers = self._bindHandlers(self.EXPR_HANDLERS)
+        self._binaryOperatorHandlers = self._bindHandlers(self.BINARY_OPERATOR_HANDLERS)
+
+        self._profileHooks = []
 
         self._prepare()
-        self.stringParser = StringParser()
-        self.HAS_JSON = True
-        self.logger.debug("Trying to load workshop.json...")
-        try:
-            self._load_workshop_json()
-        except OSError:
-            self.logger.debug("workshop.json not found, WSJSON not available")
-            self.HAS_JSON = False
 
-    def _load_workshop_json(self, path="res/workshop.json"):
+        #The string template database and workshop.json are only loaded
+        #once a script actually needs them, see stringParser and workshop_functions.
+        #loadTimes records how long each of them took to load.
+        self.workshop_json = "res/workshop.json"
+        self.loadTimes = {}
+        self._stringParser = None
+        self._workshopFunctions = None
+        self._workshopLoaded = False
 
-        self.workshop_functions = {}
-        with open(path, "r") as f:
-            d = json.load(f)
+    @property
+    def stringParser(self):
 
-        def camelCase(x):
-            words = x.split(" ")
-            if len(words) < 2:
-                return words[0].lower()
-            return "".join((words[0].lower(), *map(str.title, words[1:])))
+        """
+        String parser used for string formatting.
+        The template database is loaded the first time it is needed.
+        """
+
+        if self._stringParser is None:
+            start = time.perf_counter()
+            from string_parser import StringParser
+            self._stringParser = StringParser()
+            self.loadTimes["string templates"] = time.perf_counter() - start
+        return self._stringParser
 
-        for action in d["actions"]:
-            self.workshop_functions[camelCase(action["name"])] = (action["name"].title(), len(action["args"]))
+    @property
+    def workshop_functions(self):
 
-        for value in d["values"]:
-            self.workshop_functions[camelCase(value["name"])] = (value["name"].title(), len(value["args"]))
+        """
+        Index of the functions documented in workshop.json.
+        The index is loaded the first time it is needed and shared by all
+        compiler instances. None if workshop.json is not available.
+        """
+
+        if not self._workshopLoaded:
+            start = time.perf_counter()
+            import workshop_index
+            self._workshopFunctions = workshop_index.getIndex(self.workshop_json)
+            self._workshopLoaded = True
+            self.loadTimes["workshop.json"] = time.perf_counter() - start
+        return self._workshopFunctions
+
+    @property
+    def useNativeLoops(self):
+
+        """
+        True if loops are compiled to While and End actions.
+        """
+
+        if self.nativeLoops is None:
+            functions = self.workshop_functions
+            return functions is not None and "while" in functions and "end" in functions
+        return self.nativeLoops
+
+    @property
+    def useSubroutines(self):
+
+        """
+        True if utility functions may be compiled to subroutines.
+        """
+
+        if self.subroutines is None:
+            functions = self.workshop_functions
+            return functions is not None and "callSubroutine" in functions
+        return self.subroutines
+
+    @property
+    def HAS_JSON(self):
+
+        return self.workshop_functions is not None
+
+    def _bindHandlers(self, table):
+
+        """
+        Returns a copy of the handler table with method names replaced by bound methods.
+        """
+
+        return {cls: getattr(self, name) for cls, name in table.items()}
 
     def _prepare(self):
 
@@ -213,16 +421,26 @@ class OverScriptCompiler():
         self.rules = []
         self._utilityFunctions = {}
         self._usedFunctions = set() #keeps track of functions used in current call stack
+        self._callCounts = collections.Counter() #number of calls of each function in the script
+        self._scopes = [] #parameter names of the utility functions being parsed
+        self._subroutines = {} #function name -> (rule, returns), or None if inlined
+        self._subroutineRules = []
+        self._inlineCount = 0
+        self._returnTargets = [] #ReturnTarget of every utility function being parsed
+        self._returnCount = 0
+        self._assignedCall = None #call node whose value is assigned to a variable directly
         self._currentRule = None
         self._currentComment = ""
 
         self.global_var_names = {}
         self.player_var_names = {}
         self.func_local_var_names = {}
+        self.read_var_names = set() #(isGlobal, name) tuples of all variables read
 
         self.code = ""
 
-        self._curLoopBranch = 0
+        self._curLoopBranch = None
+        self.loop_counter_counts = {True: 0, False: 0} #loop counters allocated, global and player specific
 
     def currentLine(self):
 
@@ -230,7 +448,7 @@ class OverScriptCompiler():
         Returns the current action index.
         """
 
-        return len(self._currentRule.actions)
+        return sum(1 for action in self._currentRule.actions if action.__class__ is not ir.Label)
 
     def ruleID(self):
 
@@ -243,12 +461,49 @@ class OverScriptCompiler():
     def addAction(self, action):
 
         """
-        Adds an action to the current rule
+        Adds an action to the current rule.
+        action may be an ir.Action or any value node, which will be
+        wrapped in an ir.Action.
         """
 
-        self._currentRule.actions.append(action + ";" + (" //" + self._currentComment if self._currentComment and not self.optimize else ""))
+        if not isinstance(action, ir.Action):
+            action = ir.Action(action)
+        if self._currentComment and not self.optimize:
+            action.comment = self._currentComment
+        self._currentRule.actions.append(action)
         self._currentComment = ""
 
+    def addLabel(self, label):
+
+        """
+        Places label at the current position of the current rule.
+        """
+
+        self._currentRule.actions.append(label)
+
+    def registerPlayer(self):
+
+        """
+        Returns the node of the player owning the compiler registers
+        of the current rule, or None if the rule uses global variables.
+        """
+
+        return None if self._currentRule.isGlobal() else ir.EVENT_PLAYER
+
+    def _resolveName(self, name, player):
+
+        """
+        Returns the name and player of the variable accessed by name,
+        which differ from them for parameters of utility functions.
+        Parameters bound to constants are returned as their value node instead of a name.
+        """
+
+        if player is None and self._scopes:
+            local = self._scopes[-1].get(name)
+            if local is not None:
+                return local, self.registerPlayer()
+        return name, player
+
     def setVariable(self, name, value, player=None):
 
         """
@@ -256,24 +511,25 @@ class OverScriptCompiler():
         The variable will be created if it doesn't exist already.
         """
 
+        name, player = self._resolveName(name, player)
         self._currentComment += "var %s; " % name
         if player is None:
-            self.logger.debug("Setting global variable '%s'..." % name)
+            self.logger.debug("Setting global variable '%s'...", name)
             if name in self.global_var_names:
                 i = self.global_var_names[name]
             else:
                 i = len(self.global_var_names)
                 self.global_var_names[name] = i
-            return "Set Global Variable At Index(A, %i, %s)" % (i, value)
+            return ir.SetVariable(self.VS_VAR, i, value, None, name)
 
         else:
-            self.logger.debug("Setting player variable '%s' for '%s'..." % (name, player))
+            self.logger.debug("Setting player variable '%s' for '%s'...", name, player)
             if name in self.player_var_names:
                 i = self.player_var_names[name]
             else:
                 i = len(self.player_var_names)
                 self.player_var_names[name] = i
-            return "Set Player Variable At Index(%s, A, %i, %s)" % (player, i, value)
+            return ir.SetVariable(self.VS_VAR, i, value, player, name)
 
     def getVariable(self, name, player=None):
 
@@ -282,21 +538,25 @@ class OverScriptCompiler():
         
         """
 
+        name, player = self._resolveName(name, player)
+        if isinstance(name, ir.Node):
+            return name
         self._currentComment += "var %s; " % name
+        self.read_var_names.add((player is None, name))
         if player is None:
             if not name in self.global_var_names:
                 #create variable
 
-                #we don't actually do anything with the returned string,
+                #we don't actually do anything with the returned action,
                 #we just want to update the mapping
-                self.setVariable(name, 0, player) 
+                self.setVariable(name, ir.Literal(0), player) 
                 #raise NameError("Name '%s' is not defined" % name)
-            return "Value In Array(Global Variable(A), %i)" % self.global_var_names[name]
+            return ir.Variable(self.VS_VAR, self.global_var_names[name], None, name)
         else:
             if not name in self.player_var_names:
-                self.setVariable(name, 0, player)
+                self.setVariable(name, ir.Literal(0), player)
                 #raise NameError("Name '%s' is not defined" % name)
-            return "Value In Array(Player Variable(%s, A), %i)" % (player, self.player_var_names[name])
+            return ir.Variable(self.VS_VAR, self.player_var_names[name], player, name)
 
     def modifyVariable(self, name, action, element, player=None):
 
@@ -304,27 +564,38 @@ class OverScriptCompiler():
         Modify a global variable.
         """
 
+        name, player = self._resolveName(name, player)
         if player is None:
             if not name in self.global_var_names:
                 raise NameError("Name '%s' is not defined" % name)
-            return "Modify Global Variable At Index(A, %i, %s, %s)" % (self.global_var_names[name], action, element)
+            return ir.ModifyVariable(self.VS_VAR, self.global_var_names[name], action, element, None, name)
         else:
             if not name in self.player_var_names:
                 raise NameError("Name '%s' is not defined" % name)
-            return "Modify Player Variable At Index(A, %i, %s, %s)" % (self.player_var_names[name], action, element)
+            return ir.ModifyVariable(self.VS_VAR, self.player_var_names[name], action, element, player, name)
 
-    def setLoopBranch(self, instruction):
+    def setLoopBranch(self, label):
 
         """
-        Sets the loop branch state to the specified instruction.
+        Sets the loop branch state to the position of label.
+        If label is None, the loop branch state is reset.
         """
 
-        ind = self.ruleID()
-        if self._currentRule.isGlobal():
-            self.addAction("Set Global Variable At Index(B, %i, %s)" % (ind, instruction))
+        if label is None:
+            value = ir.Literal(0)
         else:
-            self.addAction("Set Player Variable At Index(Event Player, B, %i, %s)" % (ind, instruction))
-        self._curLoopBranch = instruction
+            value = ir.Offset(label, self._currentRule.entry)
+        self.addAction(ir.SetVariable(self.VS_LBS, self.ruleID(), value, self.registerPlayer()))
+        self._curLoopBranch = label
+
+    def _loopIterationSlot(self):
+
+        """
+        Returns the index of the loop iteration counter of the innermost loop.
+        """
+
+        rule = self._currentRule
+        return rule.loopCounters[rule.loopDepth - 1]
 
     def setLoopIteration(self, iteration):
 
@@ -332,12 +603,15 @@ class OverScriptCompiler():
         Sets the loop iteration state to the specified value.
         """
 
-        #TODO: Clean this up, break it down into multiple steps so it is easier to understand
-        ind = self.ruleID()
-        if self._currentRule.isGlobal():
-            self.addAction("Set Global Variable At Index(C, %i, Append To Array(Array Slice(Value In Array(Global Variable(C), %i), 0, Subtract(Count Of(Value In Array(Global Variable(C), %i)), 1)), %s))" % (ind, ind, ind, iteration))
-        else:
-            self.addAction("Set Player Variable At Index(Event Player, C, %i, Append To Array(Array Slice(Value In Array(Player Variable(Event Player, C), %i), 0, Subtract(Count Of(Value In Array(Player Variable(Event Player, C), %i)), 1)), %s))" % (ind, ind, ind, iteration))
+        self.addAction(ir.SetVariable(self.VS_LIS, self._loopIterationSlot(), iteration, self.registerPlayer()))
+
+    def incrementLoopIteration(self):
+
+        """
+        Advances the loop iteration state by one.
+        """
+
+        self.addAction(ir.ModifyVariable(self.VS_LIS, self._loopIterationSlot(), "Add", ir.Literal(1), self.registerPlayer()))
 
     def getLoopIteration(self):
 
@@ -345,11 +619,7 @@ class OverScriptCompiler():
         Returns the current loop iteration.
         """
 
-        ind = self.ruleID()
-        if self._currentRule.isGlobal():
-            return "Last Of(Value In Array(Global Variable(C), %i))" % ind
-        else:
-            return "Last Of(Value In Array(Player Variable(Event Player, C), %i))" % ind
+        return ir.Variable(self.VS_LIS, self._loopIterationSlot(), self.registerPlayer())
 
     def pushLoopIteration(self):
         
@@ -357,12 +627,18 @@ class OverScriptCompiler():
         Pushes a loop frame.
         """
 
-        #TODO: Clean this up, break it down into multiple steps so it is easier to understand
-        ind = self.ruleID()
-        if self._currentRule.isGlobal():
-            self.addAction("Set Global Variable At Index(C, %i, Append To Array(Value In Array(Global Variable(C), %i), 0))" % (ind, ind))
-        else:
-            self.addAction("Set Player Variable At Index(Event Playet, C, %i, Append To Array(Value In Array(Player Variable(Event Player, C), %i), 0))" % (ind, ind))
+        #Nesting is known at compile time, so every nesting depth of every rule
+        #gets a counter of its own instead of a stack we'd have to rebuild.
+        #Loops following each other share the counter of their depth.
+        #Rules may run at the same time, so they can't share counters, but global
+        #and player specific counters are numbered separately to keep both arrays dense.
+        rule = self._currentRule
+        if rule.loopDepth == len(rule.loopCounters):
+            isGlobal = rule.isGlobal()
+            rule.loopCounters.append(self.loop_counter_counts[isGlobal])
+            self.loop_counter_counts[isGlobal] += 1
+        rule.loopDepth += 1
+        self.setLoopIteration(ir.Literal(0))
 
     def pullLoopIteration(self):
 
@@ -370,12 +646,7 @@ class OverScriptCompiler():
         Pulls a loop frame.
         """
 
-        #TODO: Clean this up, break it down into multiple steps so it is easier to understand
-        ind = self.ruleID()
-        if self._currentRule.isGlobal():
-            self.addAction("Set Global Variable At Index(C, %i, Array Slice(Value In Array(Global Variable(C), %i), 0, Subtract(Count Of(Value In Array(Global Variable(C), %i)), 1)))" % (ind, ind, ind))
-        else:
-            self.addAction("Set Player Variable At Index(Event Player, C, %i, Array Slice(Value In Array(Player Variable(Event Player, C), %i), 0, Subtract(Count Of(Value In Array(Player Variable(Event Player, C), %i)), 1)))" % (ind, ind, ind))
+        self._currentRule.loopDepth -= 1
 
     def compile(self, source):
 
@@ -385,31 +656,121 @@ class OverScriptCompiler():
         returns the compiled workshop script.
         """
 
-        self._prepare()
-        self.logger.debug("Parsing AST...")
-        tree = ast.parse(source)
-        assert isinstance(tree, ast.Module)
-        self.logger.debug("Reading function definitions...")
-        rules = []
-        for rule in tree.body:
-            if isinstance(rule, ast.FunctionDef):
-                if rule.decorator_list:
-                    #Event handler function
-                    rules.append(rule)
-                else:
-                    self._parseFunctionDefAsUtility(rule)
-
-        self.logger.debug("Building ruleset...")
-        
-        #do this after parsing utility functions to prevent issues
-        for rule in rules: 
-            self._parseFunctionDefAsRule(rule)
-
-        self.code += "\n\n".join(map(str, self.rules))
+        with self._phase("compile"):
+            self._prepare()
+            if self._workshopLoaded and self._workshopFunctions is None:
+                #workshop.json may have been added since the last script was compiled
+                self._workshopLoaded = False
+            self.logger.debug("Parsing AST...")
+            with self._phase("ast.parse"):
+                tree = ast.parse(source)
+            assert isinstance(tree, ast.Module)
+            self._callCounts.update(node.func.id for node in ast.walk(tree) if isinstance(node, ast.Call) and isinstance(node.func, ast.Name))
+            self.logger.debug("Reading function definitions...")
+            rules = []
+            with self._phase("register utility functions"):
+                for rule in tree.body:
+                    if isinstance(rule, ast.FunctionDef):
+                        if rule.decorator_list:
+                            #Event handler function
+                            rules.append(rule)
+                        else:
+                            self._parseFunctionDefAsUtility(rule)
+
+            self.logger.debug("Building ruleset...")
+
+            #do this after parsing utility functions to prevent issues
+            with self._phase("parse rules"):
+                for rule in rules:
+                    with self._phase("parse rule '%s'" % rule.name):
+                        self._parseFunctionDefAsRule(rule)
+            self.rules.extend(self._subroutineRules)
+
+            with self._phase("hoist constant tables"):
+                self._hoistConstantTables()
+
+            #optimize once all rules are known, so we know which variables are used
+            self.logger.debug("Optimizing...")
+            self._optimizeRules()
+            self._checkElementLimit()
+
+            with self._phase("serialize"):
+                self.code += "\n\n".join(map(str, self.rules))
 
         self.logger.debug("Done!")
         return self.code
 
+    def addProfileHook(self, hook):
+
+        """
+        Register hook to be called whenever the compiler completes a phase.
+        hook is called with the name of the phase, the time.perf_counter()
+        value at its start and its duration in seconds. Phases may be nested.
+        See profiler.Profiler for a hook collecting totals and a trace.
+        """
+
+        self._profileHooks.append(hook)
+
+    def removeProfileHook(self, hook):
+
+        """
+        Unregister a hook added using addProfileHook().
+        """
+
+        self._profileHooks.remove(hook)
+
+    def _phase(self, name):
+
+        """
+        Returns a context manager reporting the code run inside it as phase name
+        to the profiling hooks. Does nothing if there are no hooks.
+        """
+
+        if not self._profileHooks:
+            return NO_PHASE
+        return self._profilePhase(name)
+
+    @contextlib.contextmanager
+    def _profilePhase(self, name):
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            for hook in self._profileHooks:
+                hook(name, start, duration)
+
+    def stats(self):
+
+        """
+        Returns a dictionary describing the size of the last script compiled.
+        rules holds the result of Rule.stats() for every rule, the other
+        entries the totals for the whole script.
+        """
+
+        rules = [rule.stats() for rule in self.rules]
+        stats = {"rules": rules}
+        for key in ("elements", "actions", "conditions"):
+            stats[key] = sum(rule[key] for rule in rules)
+        for key in ("variables", "slots"):
+            stats[key] = {scope: sorted(set().union(*[rule[key][scope] for rule in rules])) for scope in ("global", "player")}
+        return stats
+
+    def _checkElementLimit(self):
+
+        """
+        Raise an exception if the rules use more elements than allowed by maxElements.
+        """
+
+        if self.maxElements is None:
+            return
+        elements = [(rule.elements(), rule.name) for rule in self.rules]
+        total = sum(map(lambda x: x[0], elements))
+        if total > self.maxElements:
+            largest = ", ".join(map(lambda x: "'%s' (%i)" % (x[1], x[0]), sorted(elements, reverse=True)[:3]))
+            raise RuntimeError("Script uses %i elements, exceeding the limit of %i. Largest rules: %s" % (total, self.maxElements, largest))
+
     def _parseFunctionDefAsRule(self, node):
 
         """
@@ -439,7 +800,7 @@ class OverScriptCompiler():
                     raise RuntimeError("Only one instance of 'event' decorator allowed per rule.")
             elif f.id == "trigger":
                 for arg in dec.args:
-                    conditions.append(self._parseExpr(arg) + " == True")
+                    conditions.append(ir.Condition(self._parseExpr(arg), "==", ir.TRUE))
             else:
                 raise ValueError("Only 'event' and 'trigger' are allowed as function decorators.")
 
@@ -467,39 +828,358 @@ class OverScriptCompiler():
 
         if rule.loopCount > 0:
             #Setup loop branch instruction
-            if rule.isGlobal():
-                skipAction = "Value In Array(Global Variable(B), %i)" % self.ruleID()
-            else:
-                skipAction = "Value In Array(Player Variable(%s, B), %i)" % ("Event Player", self.ruleID())
-            rule.actions.insert(0, "Skip(%s);" % skipAction)
-            rule.actions.insert(0, "Wait(0.001, Ignore Condition);")
+            branch = ir.Variable(self.VS_LBS, self.ruleID(), self.registerPlayer())
+            rule.actions.insert(0, ir.Action(ir.Value("Skip", (branch,))))
+            rule.actions.insert(0, ir.Action(ir.Value("Wait", (ir.Literal(0.001), ir.IGNORE_CONDITION))))
+
+    def _hoistConstantTables(self):
+
+        """
+        Move constant arrays into variables set by a rule of their own.
+        """
+
+        #Arrays are rebuilt from scratch every time they are used, which is
+        #wasteful for lookup tables used in loops, conditions or by every player.
+        #Such constant arrays, and those used more than once, are built only once
+        #at the start of the match instead, in a rule placed in front of all others.
+        #Identical tables share a variable.
+        found = {}
+        for rule in self.rules:
+            perPlayer = not rule.isGlobal()
+            for condition in rule.conditions:
+                self._findTables(condition, found, True)
+            #see RegisterAllocator.count for how loops are found
+            heads = optimizer._loopHeads(rule.actions)
+            depth = 0
+            for action in rule.actions:
+                if action.__class__ is ir.Label:
+                    if action in heads:
+                        depth += 1
+                    continue
+                name = action.name
+                if name == "While":
+                    depth += 1
+                self._findTables(action, found, perPlayer or depth > 0)
+                if name == "Loop" or name == "End":
+                    depth = max(depth - 1, 0)
+
+        tables = {key: None for key, (uses, repeated) in found.items() if uses > 1 or repeated}
+        if not tables:
+            return
+
+        rule = Rule("Constant tables", (EVENTS["global"],))
+        self._currentRule = rule
+        for r in self.rules:
+            r.conditions = [self._hoistTables(condition, tables) for condition in r.conditions]
+            r.actions = [self._hoistTables(action, tables) for action in r.actions]
+        self.logger.info("Moved %i constant table(s) into rule '%s'." % (len(tables), rule.name))
+        self.rules.insert(0, rule)
 
-    def _resolveUtilityFunction(self, func_name, args, kwargs):
+    def _tableKey(self, node):
 
         """
-        Resolves a name to a sequence of actions depending on the
-        specified func_name function.
+        Returns the code of node if it is a constant array worth
+        storing in a variable, or None if it isn't.
         """
 
+        if node.__class__ is not ir.Value or node.name != "Append To Array":
+            return None
+        elements = self._arrayElements(node)
+        if elements is None or len(elements) < self.TABLE_MIN_LENGTH or not all(map(optimizer.isConstant, elements)):
+            return None
+        return str(node)
+
+    def _findTables(self, node, found, repeated):
+
+        """
+        Count the uses of all constant arrays in node.
+        found maps the code of every array to the number of its uses
+        and whether any of them may be evaluated repeatedly.
+        """
+
+        key = self._tableKey(node)
+        if key is not None:
+            uses, wasRepeated = found.get(key, (0, False))
+            found[key] = (uses + 1, wasRepeated or repeated)
+            return
+        for child in node.children():
+            self._findTables(child, found, repeated)
+
+    def _hoistTables(self, node, tables):
+
+        """
+        Replace the constant arrays in node which are keys of tables with
+        the variable holding them. Variables are created as needed.
+        """
+
+        key = self._tableKey(node)
+        if key in tables:
+            variable = tables[key]
+            if variable is None:
+                name = "table #%i" % sum(1 for v in tables.values() if v is not None)
+                self.addAction(self.setVariable(name, node))
+                self.read_var_names.add((True, name))
+                variable = tables[key] = self._currentRule.actions[-1].target()
+            return variable
+
+        children = node.children()
+        if not children:
+            return node
+        new = [self._hoistTables(child, tables) for child in children]
+        for old, child in zip(children, new):
+            if old is not child:
+                return node.rebuild(new)
+        return node
+
+    def _optimizeRules(self):
+
+        """
+        Run all optimization passes on the rules.
+        """
+
+        for optimize in self.OPTIMIZATION_PASSES:
+            with self._phase("optimize %s" % optimize.__name__):
+                optimize(self, self.rules)
+
+    def _resolveUtilityFunction(self, func_name, args, kwargs, copyResult=True):
+
+        """
+        Resolves a call of the utility function func_name to a sequence of actions.
+        Returns the value returned by the function, or None.
+        If copyResult is False, the value is used before the function is called again.
+        """
+
+        #Arguments are stored in variables named after the parameters they are
+        #bound to, which the function body then reads. The body itself is inlined,
+        #unless the function is large and called from several places. In that case
+        #it is compiled once as a subroutine, which reads its parameters from
+        #variables shared by all calls and stores its result in another one.
+
         if not func_name in self._utilityFunctions:
             raise ValueError("No such function: '%s'" % func_name)
 
+        #safety check for recursion
         if func_name in self._usedFunctions:
             raise RecursionError("Recursion not allowed in utility functions.")
 
-        self._usedFunctions.add(func_name)
-
-        #safety check for recursion
         func = self._utilityFunctions[func_name]
-
+        values = self._bindArguments(func, args, kwargs)
+        player = self.registerPlayer()
+
+        subroutine = self._getSubroutine(func)
+        if subroutine is None:
+            #every inlined call gets variables of its own, so results
+            #reading the parameters stay valid until they are used
+            #constant arguments are used directly, unless the function assigns to them
+            assigned = {node.id for node in ast.walk(func) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)}
+            scope = {}
+            for param, value in values.items():
+                if optimizer.isConstant(value) and not param in assigned:
+                    scope[param] = value
+                else:
+                    scope[param] = "%s.%s#%i" % (func_name, param, self._inlineCount)
+                    self.addAction(self.setVariable(scope[param], value, player))
+            self._inlineCount += 1
+            value = self._parseUtilityBody(func, scope)
+            if value is None or not copyResult:
+                return value
+            #the value may read variables assigned by the function,
+            #which the next call overwrites, so copy it in that case
+            stored = {node.id for node in self._utilityNodes(func, set()) if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store)}
+            if not self._readsVariables(value, stored):
+                return value
+            name = "%s.result#%i" % (func_name, self._inlineCount)
+            self._inlineCount += 1
+            self.addAction(self.setVariable(name, value, player))
+            return self.getVariable(name, player)
+
+        rule, returns = subroutine
+        for param, value in values.items():
+            self.addAction(self.setVariable("%s.%s" % (func_name, param), value))
+        self.addAction(ir.Value("Call Subroutine", (ir.Value(rule.events[1]),)))
+        if not returns:
+            return None
+        result = self.getVariable("%s.return" % func_name)
+        if not copyResult:
+            return result
+        #copy the result, since the next call overwrites it
+        name = "%s.result#%i" % (func_name, self._inlineCount)
+        self._inlineCount += 1
+        self.addAction(self.setVariable(name, result, player))
+        return self.getVariable(name, player)
+
+    def _readsVariables(self, node, names):
+
+        """
+        Check whether node reads any of the variables in names.
+        """
+
+        if node.__class__ is ir.Variable and node.name in names:
+            return True
+        return any(self._readsVariables(child, names) for child in node.children())
+
+    def _bindArguments(self, func, args, kwargs):
+
+        """
+        Match the arguments of a call to the parameters of the utility function func.
+        args is a list of argument nodes, kwargs a dictionary of parsed keyword arguments.
+        Returns a dictionary mapping parameter names to parsed values.
+        """
+
+        params = [arg.arg for arg in func.args.args]
+        if len(args) > len(params):
+            raise TypeError("%s() takes %i arguments but %i were given." % (func.name, len(params), len(args)))
+
+        values = dict(zip(params, map(self._parseExpr, args)))
+        for name, value in kwargs.items():
+            if not name in params:
+                raise TypeError("%s() got an unexpected keyword argument '%s'." % (func.name, name))
+            if name in values:
+                raise TypeError("%s() got multiple values for argument '%s'." % (func.name, name))
+            values[name] = value
+
+        defaults = func.args.defaults
+        for param, default in zip(params[len(params) - len(defaults):], defaults):
+            if not param in values:
+                values[param] = self._parseExpr(default)
+
+        for param in params:
+            if not param in values:
+                raise TypeError("%s() missing argument '%s'." % (func.name, param))
+        return {param: values[param] for param in params}
+
+    def _parseUtilityBody(self, func, scope):
+
+        """
+        Parse the body of the utility function func. scope maps the names of
+        its parameters to the variables storing them, or to their constant values.
+        Returns the value returned by the function, or None.
+        """
+
+        target = ReturnTarget("%s.return#%i" % (func.name, self._returnCount))
+        self._returnCount += 1
+        self._usedFunctions.add(func.name)
+        self._scopes.append(scope)
+        self._returnTargets.append(target)
+        value = None
         try:
             for instr in func.body:
                 self._parseBody(instr)
         except FunctionReturned as e:
-            self._usedFunctions.discard(func_name)
-            return e.value
-        self._usedFunctions.discard(func_name)
-        return None
+            value = e.value
+        finally:
+            self._returnTargets.pop()
+            self._scopes.pop()
+            self._usedFunctions.discard(func.name)
+        if not target.used:
+            return value
+
+        #some return statements jump to the end of the function,
+        #so the value has to be stored where they store theirs
+        player = self.registerPlayer()
+        if target.hasValue:
+            self.addAction(self.setVariable(target.name, ir.NULL if value is None else value, player))
+        self.addLabel(target.label)
+        if target.hasValue:
+            return self.getVariable(target.name, player)
+        return value
+
+    def _getSubroutine(self, func):
+
+        """
+        Returns a tuple (rule, returns) describing the subroutine of the utility
+        function func, or None if func should be inlined.
+        The subroutine is compiled the first time it is needed.
+        """
+
+        if not self.useSubroutines or self._callCounts[func.name] < 2:
+            return None
+        if not func.name in self._subroutines:
+            self._subroutines[func.name] = self._compileSubroutine(func)
+        return self._subroutines[func.name]
+
+    def _utilityNodes(self, func, visited):
+
+        """
+        Yields all AST nodes of the utility function func
+        and of all utility functions it calls.
+        """
+
+        visited.add(func.name)
+        for node in ast.walk(func):
+            yield node
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name):
+                name = node.func.id
+                if name in self._utilityFunctions and not name in visited:
+                    yield from self._utilityNodes(self._utilityFunctions[name], visited)
+
+    def _compileSubroutine(self, func):
+
+        """
+        Compile the utility function func to a subroutine.
+        Returns a tuple (rule, returns), or None if func should be inlined.
+        """
+
+        #Subroutines run in the context of the rule calling them, so they
+        #use global variables for everything to be callable from any rule.
+        #Since other rules may run while a rule waits, functions which may wait
+        #are always inlined. So are functions with loops built from Loop actions,
+        #which would restart the calling rule.
+        for node in self._utilityNodes(func, set()):
+            if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "wait":
+                return None
+            if not self.useNativeLoops and isinstance(node, (ast.While, ast.For)):
+                return None
+
+        #variables created for the subroutine are forgotten if the function is inlined after all
+        names = (dict(self.global_var_names), dict(self.player_var_names), set(self.read_var_names))
+        subroutines = len(self._subroutineRules)
+
+        rule = Rule(func.name, ("Subroutine",))
+        state = (self._currentRule, self._currentComment, self._curLoopBranch)
+        self._currentRule = rule
+        self._currentComment = ""
+        self._curLoopBranch = None
+        try:
+            scope = {arg.arg: "%s.%s" % (func.name, arg.arg) for arg in func.args.args}
+            value = self._parseUtilityBody(func, scope)
+            if value is not None:
+                self.addAction(self.setVariable("%s.return" % func.name, value))
+        finally:
+            self._currentRule, self._currentComment, self._curLoopBranch = state
+
+        #A call costs the Call Subroutine action and storing the arguments,
+        #inlining costs the entire function at every call.
+        elements = sum(action.elements() for action in rule.actions)
+        calls = self._callCounts[func.name]
+        if elements <= self.INLINE_MAX_ELEMENTS or elements * (calls - 1) <= calls * (2 + 3 * len(scope)):
+            self.logger.debug("Inlining utility function '%s' (%i elements)." % (func.name, elements))
+            self.global_var_names, self.player_var_names, self.read_var_names = names
+            #subroutines of the functions called by func are kept, and so are their variables
+            for nested in self._subroutineRules[subroutines:]:
+                self._registerVariables(nested)
+            return None
+        rule.events = ("Subroutine", "Sub%i" % len(self._subroutineRules))
+        self._subroutineRules.append(rule)
+        self.logger.debug("Compiled utility function '%s' to subroutine %s (%i elements)." % (func.name, rule.events[1], elements))
+        return rule, value is not None
+
+    def _registerVariables(self, rule):
+
+        """
+        Register the variables accessed by rule as if it had just been parsed.
+        """
+
+        stack = list(rule.conditions) + rule.actions
+        while stack:
+            node = stack.pop()
+            cls = node.__class__
+            if (cls is ir.Variable or cls is ir.SetVariable or cls is ir.ModifyVariable) and node.var == self.VS_VAR and node.name is not None:
+                names = self.global_var_names if node.player is None else self.player_var_names
+                names.setdefault(node.name, len(names))
+                if cls is ir.Variable:
+                    self.read_var_names.add((node.player is None, node.name))
+            stack.extend(node.children())
 
     def _parseFunctionDefAsUtility(self, node):
 
@@ -515,32 +1195,93 @@ class OverScriptCompiler():
         """
         Parse a rule body.
         """
-        
-        if isinstance(node, ast.Assign):
-            self.addAction(self._assign(node))
-        elif isinstance(node, ast.While):
-            self._parseWhile(node)
-        elif isinstance(node, ast.If):
-            self._parseIf(node)
-        elif isinstance(node, ast.Expr):
-            self.addAction(self._parseExpr(node.value))
-        elif isinstance(node, ast.AugAssign):
-            #Since we already have assignment and binary ops wokring,
-            #I'm just gonna cheese this one...
-            binOpNode = ast.BinOp()
-            binOpNode.left = node.target
-            binOpNode.right = node.value
-            binOpNode.op = node.op
-            assignNode = ast.Assign()
-            assignNode.targets = [node.target]
-            assignNode.value = binOpNode
-            self.addAction(self._assign(assignNode))
-        elif isinstance(node, ast.For):
-            self._parseFor(node)
-        elif isinstance(node, ast.Return):
-            raise FunctionReturned(self._parseExpr(node.value))
-        else:
+
+        handler = self._bodyHandlers.get(node.__class__)
+        if handler is None:
             raise RuntimeError("Unsupported node %s" % str(node))
+        handler(node)
+
+    def _parseBlock(self, nodes, loop=False):
+
+        """
+        Parse the statements nested in a control structure.
+        loop should be True for the bodies of loops.
+        """
+
+        target = self._returnTargets[-1] if self._returnTargets else None
+        if target is None:
+            for i in nodes:
+                self._parseBody(i)
+            return
+
+        #jumps around the block target labels placed after it, so the
+        #block has to be left normally even if the function returns in it
+        target.depth += 1
+        target.loops += loop
+        try:
+            for i in nodes:
+                self._parseBody(i)
+        except FunctionReturned:
+            #the return statement jumps to the end of the function,
+            #so the rest of the block is unreachable
+            pass
+        finally:
+            target.depth -= 1
+            target.loops -= loop
+
+    def _parseAssign(self, node):
+
+        """
+        Parses an Assign node.
+        """
+
+        self.addAction(self._assign(node))
+
+    def _parseExprStatement(self, node):
+
+        """
+        Parses an expression used as a statement.
+        """
+
+        value = self._parseExpr(node.value)
+        if value is not None: #utility functions may not return anything
+            self.addAction(value)
+
+    def _parseAugAssign(self, node):
+
+        """
+        Parses an AugAssign node.
+        """
+
+        #Since we already have assignment and binary ops wokring,
+        #I'm just gonna cheese this one...
+        binOpNode = ast.BinOp()
+        binOpNode.left = node.target
+        binOpNode.right = node.value
+        binOpNode.op = node.op
+        assignNode = ast.Assign()
+        assignNode.targets = [node.target]
+        assignNode.value = binOpNode
+        self.addAction(self._assign(assignNode))
+
+    def _parseReturn(self, node):
+
+        """
+        Parses a Return node.
+        """
+
+        value = None if node.value is None else self._parseExpr(node.value)
+        target = self._returnTargets[-1] if self._returnTargets else None
+        if target is not None and target.depth:
+            #returning from inside a block, store the value and jump to the end of the function
+            if target.loops:
+                raise NotImplementedError("Return statements inside of loops are not supported by OverScript.")
+            if value is not None:
+                self.addAction(self.setVariable(target.name, value, self.registerPlayer()))
+                target.hasValue = True
+            self.addAction(ir.Value("Skip", (ir.Offset(target.label),)))
+            target.used = True
+        raise FunctionReturned(value)
 
     def _parseIf(self, node):
 
@@ -563,27 +1304,17 @@ class OverScriptCompiler():
         #it here. After that we need to skip the if block in the else block and vice
         #versa.
         
-        #First we create the if and else blocks
-        body = node.body
-        orelse = node.orelse
-        ifInd = self.currentLine()
-        self.addAction("PLACEHOLDER") #this will later test the condition and skip the else block
-        if orelse:
-            for i in orelse:
-                self._parseBody(i)
-        elseInd = self.currentLine()
-        self.addAction("PLACEHOLDER") #this will later skip the if block if the else block was executed
-        for i in body:
-            self._parseBody(i)
-        end = self.currentLine()
-
-        self._currentRule.actions[elseInd] = "Skip(%i);" % (end - elseInd - 1) #skip if block in else block
-
-        #Now that we know what our action pointers need to be set to,
-        #we can create the actual If statement
-
-        expr = self._parseCompare(node.test)
-        self._currentRule.actions[ifInd] = "Skip If(%s, %i);" % (expr, elseInd - ifInd)
+        #Jump targets are labels, which get resolved to action offsets
+        #once the rule is serialized, so we can emit everything in order.
+        expr = self._parseExpr(node.test)
+        bodyLabel = ir.Label("if")
+        endLabel = ir.Label("endif")
+        self.addAction(ir.Value("Skip If", (expr, ir.Offset(bodyLabel)))) #skip the else block if the condition holds
+        self._parseBlock(node.orelse)
+        self.addAction(ir.Value("Skip", (ir.Offset(endLabel),))) #skip if block in else block
+        self.addLabel(bodyLabel)
+        self._parseBlock(node.body)
+        self.addLabel(endLabel)
 
     def _parseCompare(self, node):
 
@@ -601,14 +1332,14 @@ class OverScriptCompiler():
         elif opName == "In":
             #special case for use with Array Contains
             array = self._parseExpr(node.comparators[0])
-            return "Array Contains(%s, %s)" % (array, left)
+            return ir.Value("Array Contains", (array, left))
         else:
             raise NotImplementedError("Unknown operator '%s'." % opName)
         comps = node.comparators
         if len(comps) > 1:
             raise NotImplementedError("Multiple comparators are not supported by OverScript.")
         comp = self._parseExpr(comps[0])
-        return "Compare(%s, %s, %s)" % (left, op, comp)
+        return ir.Value("Compare", (left, ir.Literal(op), comp))
 
     def _parseWhile(self, node):
 
@@ -631,7 +1362,7 @@ class OverScriptCompiler():
         #   init array b = 0 //the first action index is 0 because it is what is called by default when no loop is running (no skip)
         #   skip b //skip to wherever the current loop is
         #   ...
-        #   [line 24] set b = 24 //this is where the loop starts
+        #   [line 24] set b = 24 //this is where the loop starts (a label, resolved when serializing)
         #   ...
         #   Loop If <some condition> //this loops back to the beginning, which will then immediately jump back to line 24
         #   set b = 0 //loop is complete, reset b to make sure the rule can run properly next iteration
@@ -647,25 +1378,32 @@ class OverScriptCompiler():
         #already another Wait instruction before it. This means we can't skip into the loop from the top unless
         #we add a slight delay to the entire function (at least 0.25 seconds). Currently thinking of how to
         #circumvent this behavior but I don't think there is one.
+        #
+        #Luckily, the workshop has since gained structured loops, so if While is available
+        #we use that instead.
+
+        if self.useNativeLoops:
+            return self._parseNativeWhile(node)
 
         self._currentRule.loopCount += 1
         lastLoopBranch = self._curLoopBranch
 
-        #set loop branch target
+        loopLabel = ir.Label("while") #This is where we jump to
+        endLabel = ir.Label("endwhile")
+        self.addLabel(loopLabel)
+
+        #skip the loop if the condition doesn't hold
         expr = self._parseExpr(node.test)
-        
-        currentInd = self.currentLine() #This is where we jump to
-        self.addAction("PLACEHOLDER") #where we skip the loop if the condition doesn't hold
-        self.setLoopBranch(currentInd - 1)
+        self.addAction(ir.Value("Skip If", (optimizer.foldValue(ir.Value("Not", (expr,))), ir.Offset(endLabel))))
+        #set loop branch target
+        self.setLoopBranch(loopLabel)
         
         #parse instruction block
-        for i in node.body:
-            self._parseBody(i)
+        self._parseBlock(node.body, loop=True)
 
         #add loop instruction
-        self.addAction("Loop()")
-        #replace placeholder with condition test
-        self._currentRule.actions[currentInd] = "Skip If(Not(%s), %i);" % (expr, (self.currentLine() - currentInd) - 1)
+        self.addAction(ir.Value("Loop", ()))
+        self.addLabel(endLabel)
         #reset loop branch target
         self.setLoopBranch(lastLoopBranch)
 
@@ -682,6 +1420,11 @@ class OverScriptCompiler():
         #using the same variable to store the current loop element would override each other, potentially
         #introducing race conditions.
 
+        if self._unrollFor(node):
+            return
+        if self.useNativeLoops:
+            return self._parseNativeFor(node)
+
         self._currentRule.loopCount += 1
         lastBranch = self._curLoopBranch #cache current loop branch to allow for nested loops
 
@@ -689,34 +1432,138 @@ class OverScriptCompiler():
         self.pushLoopIteration()
 
         #set loop branch target
-        currentInd = self.currentLine() #This is where we jump to
-        self.setLoopBranch(currentInd)
+        loopLabel = ir.Label("for") #This is where we jump to
+        endLabel = ir.Label("endfor")
+        self.addLabel(loopLabel)
+        self.setLoopBranch(loopLabel)
 
         #get target and iterator from node
         iter = self._parseExpr(node.iter)
         target = node.target
 
         #use skip here to make sure we don't run the loop if the condition doesn't hold.
-        skipInd = self.currentLine()
-        self.addAction("PLACEHOLDER")
+        done = ir.Value("Compare", (ir.Value("Count Of", (iter,)), ir.Literal("<="), self.getLoopIteration()))
+        self.addAction(ir.Value("Skip If", (done, ir.Offset(endLabel))))
         #Set loop variable to store current array element
-        self.addAction(self.setVariable(target.id, "Value In Array(%s, %s)" % (iter, self.getLoopIteration())))
+        self.addAction(self.setVariable(target.id, ir.Value("Value In Array", (iter, self.getLoopIteration()))))
         
         #parse instruction block
-        for i in node.body:
-            self._parseBody(i)
+        self._parseBlock(node.body, loop=True)
 
         #increment array pointer
-        self.setLoopIteration("Add(%s, %i)" % (self.getLoopIteration(), 1))
+        self.incrementLoopIteration()
 
         #add loop instruction
-        self.addAction("Loop()")
-        #replace skip placeholder
-        self._currentRule.actions[skipInd] = "Skip If(Compare(Count Of(%s), <=, %s), %i);" % (iter, self.getLoopIteration(), (self.currentLine() - skipInd) - 1)
+        self.addAction(ir.Value("Loop", ()))
+        self.addLabel(endLabel)
         #reset loop branch target and loop index
         self.setLoopBranch(lastBranch)
         self.pullLoopIteration()
 
+    def _arrayElements(self, value):
+
+        """
+        Returns the elements of value if it is an array built
+        by _create_1d_array, or None if it isn't.
+        """
+
+        elements = []
+        while value.__class__ is ir.Value and value.name == "Append To Array":
+            value, element = value.args
+            elements.append(element)
+        if value.__class__ is not ir.Value or value.name != "Empty Array":
+            return None
+        elements.reverse()
+        return elements
+
+    def _constantElements(self, value):
+
+        """
+        Returns the elements of value if it is an array
+        of literals, or None if it isn't.
+        """
+
+        elements = self._arrayElements(value)
+        if elements is None or any(element.__class__ is not ir.Literal for element in elements):
+            return None
+        return elements
+
+    def _unrollFor(self, node):
+
+        """
+        Attempts to unroll a for loop over a constant array.
+        Returns True if the loop was unrolled, False if it needs to be compiled as a loop.
+        """
+
+        #Loops over list literals and range() don't need any loop state at all if
+        #we simply repeat their body for every element, as long as that doesn't cost too
+        #many elements. If it does, we throw away the unrolled code and build a loop instead.
+        iterations, budget = self.UNROLL_BUDGETS[min(int(self.optimize), len(self.UNROLL_BUDGETS) - 1)]
+        rule = self._currentRule
+        start = len(rule.actions)
+        loopCount = rule.loopCount
+        loopCounters = len(rule.loopCounters)
+        counts = (dict(self.loop_counter_counts), self._inlineCount, self._returnCount, len(self._subroutineRules))
+        comment = self._currentComment
+
+        elements = self._constantElements(self._parseExpr(node.iter))
+        if elements is not None and len(elements) <= iterations and len(rule.actions) == start:
+            used = 0
+            for element in elements:
+                end = len(rule.actions)
+                self.addAction(self.setVariable(node.target.id, element))
+                self._parseBlock(node.body, loop=True)
+                used += sum(action.elements() for action in rule.actions[end:])
+                if used > budget:
+                    self.logger.debug("Not unrolling loop at line %i: Exceeds budget of %i elements." % (node.lineno, budget))
+                    break
+            else:
+                return True
+
+        del rule.actions[start:]
+        rule.loopCount = loopCount
+        del rule.loopCounters[loopCounters:]
+        self.loop_counter_counts = counts[0]
+        #subroutines compiled meanwhile may use the names numbered since
+        if len(self._subroutineRules) == counts[3]:
+            self._inlineCount, self._returnCount = counts[1:3]
+        self._currentComment = comment
+        return False
+
+    def _parseNativeWhile(self, node):
+
+        """
+        Parse a While node using the While action.
+        """
+
+        self.addAction(ir.Value("While", (self._parseExpr(node.test),)))
+        self._parseBlock(node.body, loop=True)
+        self.addAction(ir.Value("End"))
+
+    def _parseNativeFor(self, node):
+
+        """
+        Parse a for loop node using the While action.
+        """
+
+        #For Global Variable would need a variable of its own for every loop,
+        #so we iterate using the loop iteration state just like _parseFor does.
+        self.pushLoopIteration()
+
+        iter = self._parseExpr(node.iter)
+        target = node.target
+
+        #loop as long as there are elements left
+        left = ir.Value("Compare", (ir.Value("Count Of", (iter,)), ir.Literal(">"), self.getLoopIteration()))
+        self.addAction(ir.Value("While", (left,)))
+        self.addAction(self.setVariable(target.id, ir.Value("Value In Array", (iter, self.getLoopIteration()))))
+
+        self._parseBlock(node.body, loop=True)
+
+        self.incrementLoopIteration()
+        self.addAction(ir.Value("End"))
+        self.pullLoopIteration()
+
     def _parseCall(self, node):
 
         """
@@ -726,7 +1573,7 @@ class OverScriptCompiler():
         #Function calls usually indicate that the programmer wants to
         #run some sort of function from the Workshop. In most cases,
         #we delegate these objects to the specific function implementation
-        #to resolve into text and just return the result.
+        #to resolve into IR nodes and just return the result.
 
         funcName = node.func.id
 
@@ -739,7 +1586,7 @@ class OverScriptCompiler():
 
         #utility functions
         if funcName in self._utilityFunctions:
-            return self._resolveUtilityFunction(funcName, args, kwargs)
+            return self._resolveUtilityFunction(funcName, args, kwargs, node is not self._assignedCall)
 
         if not hasattr(owwlib, funcName):
 
@@ -748,14 +1595,15 @@ class OverScriptCompiler():
             if kwargs:
                 self.logger.warn("Found non empty kwargs for unknown function, kwargs will be passed as positional args instead.")
                 parsed_args.extend(kwargs.values())
-            if self.HAS_JSON:
+            workshop_functions = self.workshop_functions
+            if workshop_functions is not None:
                 #use workshop.json to find function definition
-                if funcName in self.workshop_functions:
-                    canon_name, arg_count = self.workshop_functions[funcName]
+                if funcName in workshop_functions:
+                    canon_name, arg_count, arg_types = workshop_functions[funcName]
                     if len(parsed_args) != arg_count:
                         raise TypeError("Unexpected number of arguments for function '%s' (%s): Expected %i but was %i." % (funcName, canon_name, arg_count, len(parsed_args)))
-                    func = "%s(%s)" % (canon_name, ", ".join(parsed_args))
-                    self.logger.debug("Calling WSJSON function '%s'" % (func))
+                    func = ir.Value(canon_name, tuple(parsed_args))
+                    self.logger.debug("Calling WSJSON function '%s'", func)
                     return func
 
             if not self.parseUnknownFunctions:
@@ -763,8 +1611,8 @@ class OverScriptCompiler():
             else:
                 self.logger.info("Function '%s' not found, guessing signature from call node..." % funcName)
 
-                func = "%s(%s)" % (funcName, ", ".join(parsed_args))
-                self.logger.debug("Calling unknown function '%s'" % (func))
+                func = ir.Value(funcName, tuple(parsed_args))
+                self.logger.debug("Calling unknown function '%s'", func)
                 return func
 
         #call function and return
@@ -777,78 +1625,116 @@ class OverScriptCompiler():
         Parse an expression yielding some value.
         """
 
-        if isinstance(node, ast.Call):
-            value = self._parseCall(node)
-        elif isinstance(node, ast.Name):
-            if node.id == "player":
-                value = "Event Player"
-            elif node.id == "attacker":
-                value = "Attacker"
-            elif node.id == "Victim":
-                value = "Victim"
-            else:
-                value = self.getVariable(node.id)
-        elif isinstance(node, ast.Subscript):
-            array = self._parseExpr(node.value)
-            ind = self._parseExpr(node.slice.value)
-            value = "Value In Array(%s, %s)" % (array, ind)
-        elif isinstance(node, (ast.List, ast.Tuple)):
-            value = self._parseArray(node, parse_array)
-        elif isinstance(node, ast.BinOp):
-            value = self._parseBinaryOp(node)
-        elif isinstance(node, ast.Compare):
-            value = self._parseCompare(node)
-        elif isinstance(node, ast.Attribute):
-            base = node.value
-            attr = node.attr
-            if base.id == "player":
-                player = "Event Player"
-            else:
-                player = base.id
-            value = self.getVariable(attr, player)
+        if not parse_array and node.__class__ in (ast.List, ast.Tuple):
+            return self._parseArray(node, parse_array)
+
+        handler = self._exprHandlers.get(node.__class__)
+        if handler is None:
+            return self._parseLiteral(node)
+        #Arguments have been folded while parsing them,
+        #so this folds the entire expression bottom up.
+        return optimizer.foldValue(handler(node))
+
+    def _parseName(self, node):
+
+        """
+        Parses a Name node, which is either a keyword or a variable.
+        """
+
+        if node.id == "player":
+            return ir.EVENT_PLAYER
+        elif node.id == "attacker":
+            return ir.Value("Attacker")
+        elif node.id == "Victim":
+            return ir.Value("Victim")
+        return self.getVariable(node.id)
+
+    def _parseSubscript(self, node):
+
+        """
+        Parses a Subscript node.
+        """
+
+        array = self._parseExpr(node.value)
+        index = node.slice
+        #Python < 3.9 wraps the index expression in an Index node
+        if hasattr(ast, "Index") and isinstance(index, ast.Index):
+            index = index.value
+        ind = self._parseExpr(index)
+        return ir.Value("Value In Array", (array, ind))
+
+    def _parseAttribute(self, node):
+
+        """
+        Parses an Attribute node, which refers to a player variable.
+        """
+
+        base = node.value
+        attr = node.attr
+        if base.id == "player":
+            player = ir.EVENT_PLAYER
+        else:
+            player = ir.Value(base.id)
+        return self.getVariable(attr, player)
+
+    def _parseLiteral(self, node):
+
+        """
+        Parses a node which is expected to be a literal value.
+        """
+
+        if node.__class__ is ast.Constant:
+            value = node.value
         else:
-            value = str(ast.literal_eval(node))
+            value = ast.literal_eval(node)
+        if isinstance(value, str):
             if self.correctAccents:
                 value = value.replace("Lucio", "Lúcio") #allow the qwerty-friendly spelling of Lucio
             else:
                 if value.find("Lucio") > -1:
                     self.logger.warn("String 'Lucio' at line %i, column %i is a common misspelling of 'Lúcio'." % (node.lineno, node.col_offset))
+        return ir.Literal(value)
 
-        return value
+    def _parseConstant(self, node):
+
+        """
+        Parses a node which has to evaluate to a constant value
+        and returns that value.
+        """
+
+        value = self._parseExpr(node)
+        if not isinstance(value, ir.Literal):
+            raise TypeError("Expected a constant value at line %i, column %i." % (node.lineno, node.col_offset))
+        return value.value
 
     def _parseBinaryOp(self, node):
 
+        op = node.op.__class__
+        handler = self._binaryOperatorHandlers.get(op)
+        if handler is not None:
+            return handler(node)
+        if not op in BINARY_OPERATORS:
+            raise RuntimeError("Unrecognized binary operator '%s'" % str(node.op))
         left = self._parseExpr(node.left)
         right = self._parseExpr(node.right)
-        op = node.op
-        if isinstance(op, ast.Add):
-            return "Add(%s, %s)" % (left, right)
-        elif isinstance(op, ast.Sub):
-            return "Subtract(%s, %s)" % (left, right)
-        elif isinstance(op, ast.Mult):
-            return "Multiply(%s, %s)" % (left, right)
-        elif isinstance(op, ast.Div):
-            return "Divide(%s, %s)" % (left, right)
-        elif isinstance(op, ast.Mod):
-            return "Modulo(%s, %s)" % (left, right)
-        elif isinstance(op, ast.Pow):
-            return "Raise To Power(%s, %s)" % (left, right)
-        elif isinstance(op, ast.And):
-            return "And(%s, %s)" % (left, right)
-        elif isinstance(op, ast.Or):
-            return "Or(%s, %s)" % (left, right)
-        elif isinstance(op, ast.LShift):
-            #<< is used for string formatting.
-            #This requires the left side argument to be a string and
-            #the right side to be a tuple of elements
-            if not isinstance(node.left, ast.Str):
-                raise TypeError("Can't use string format operator here; Expected target of type '%s' but was '%s'" % (str(ast.Str), str(node.left.__class__)))
-            if not isinstance(node.right, ast.Tuple):
-                raise TypeError("Expected string format list of type '%s' but was '%s'" % (str(ast.Tuple), str(node.right.__class__)))
-            parameters = list(map(self._parseExpr, node.right.elts))
-            return self.stringParser.parse(self._parseExpr(node.left).lower(), parameters)
-        else:
-            raise RuntimeError("Unrecognized binary operator '%s'" % str(op))
+        return ir.Value(BINARY_OPERATORS[op], (left, right))
+
+    def _parseStringFormat(self, node):
+
+        """
+        Parses a string format operation.
+        """
+
+        #<< is used for string formatting.
+        #This requires the left side argument to be a string and
+        #the right side to be a tuple of elements
+        if not isinstance(node.left, ast.Str):
+            raise TypeError("Can't use string format operator here; Expected target of type '%s' but was '%s'" % (str(ast.Str), str(node.left.__class__)))
+        if not isinstance(node.right, ast.Tuple):
+            raise TypeError("Expected string format list of type '%s' but was '%s'" % (str(ast.Tuple), str(node.right.__class__)))
+        parameters = list(map(self._parseExpr, node.right.elts))
+        with self._phase("string templates"):
+            return self.stringParser.parse(self._parseLiteral(node.left).value.lower(), parameters)
 
     def _assign(self, node):
 
@@ -862,6 +1748,7 @@ class OverScriptCompiler():
             raise SyntaxError("List unpacking is not supported by OverScript.")
         target = targets[0]
         
+        self._assignedCall = node.value
         value = self._parseExpr(node.value)
 
         #Determine target
@@ -871,9 +1758,9 @@ class OverScriptCompiler():
             base = target.value
             attr = target.attr
             if base.id == "player":
-                player = "Event Player"
+                player = ir.EVENT_PLAYER
             else:
-                player = base.id
+                player = ir.Value(base.id)
             return self.setVariable(attr, value, player)
         else:
             raise RuntimeError("Unexpected assignment target node type: '%s'" % str(target.__class__))
@@ -888,10 +1775,7 @@ class OverScriptCompiler():
         Clears the specified variable.
         """
 
-        if player:
-            self.addAction("Set Player Variable(%s, %s, Empty Array)" % (player, target))
-        else:
-            self.addAction("Set Global Variable(%s, Empty Array)" % target)
+        self.addAction(ir.SetVariable(target, None, ir.EMPTY_ARRAY, player))
 
     def _array_esc(self, source, target, player=None):
         
@@ -900,10 +1784,7 @@ class OverScriptCompiler():
         """
 
         self._array_clear(target, player)
-        if player:
-            self.addAction("Set Player Variable At Index(%s, %s, 0, Player Variable(%s, %s))" % (player, target, player, source))
-        else:
-            self.addAction("Set Global Variable At Index(%s, 0, Global Variable(%s))" % (target, source))
+        self.addAction(ir.SetVariable(target, 0, ir.Variable(source, None, player), player))
 
     def _array_esc_val(self, source, target, player=None):
 
@@ -912,10 +1793,7 @@ class OverScriptCompiler():
         """
 
         self._array_clear(target, player)
-        if player:
-            self.addAction("Set Player Variable At Index(%s, %s, 0, %s)" % (player, target, source))
-        else:
-            self.addAction("Set Global Variable At Index(%s, 0, %s)" % (target, source))
+        self.addAction(ir.SetVariable(target, 0, source, player))
 
     def _array_ata(self, source, target, index, player=None):
 
@@ -923,10 +1801,7 @@ class OverScriptCompiler():
         append to array
         """
 
-        if player:
-            return "Append To Array(%s, Value In Array(Player Variable(%s, %s), %i))" % (target, player, source, index)
-        else:
-            return "Append To Array(%s, Value In Array(Global Variable(%s), %i))" % (target, source, index)
+        return ir.Value("Append To Array", (target, ir.Variable(source, index, player)))
 
     def _array_set(self, target, value, player=None):
 
@@ -934,10 +1809,7 @@ class OverScriptCompiler():
         Set variable
         """
 
-        if player:
-            self.addAction("Set Player Variable(%s, %s, %s)" % (player, target, value))
-        else:
-            self.addAction("Set Global Variable(%s, %s)" % (target, value))
+        self.addAction(ir.SetVariable(target, None, value, player))
 
     def _array_push_stack(self, target, source, index, player=None):
 
@@ -947,10 +1819,7 @@ class OverScriptCompiler():
         target at the specified index.
         """
 
-        if player:
-            self.addAction("Set Player Variable At Index(%s, %s, %i, Player Variable(%s, %s))" % (player, target, index, player, source))
-        else:
-            self.addAction("Set Global Variable At Index(%s, %i, Global Variable(%s))" % (target, index, source))
+        self.addAction(ir.SetVariable(target, index, ir.Variable(source, None, player), player))
 
     def _array_build(self, tos, array):
 
@@ -958,7 +1827,7 @@ class OverScriptCompiler():
         build an n dimensional array
         """
 
-        player = None if self._currentRule.isGlobal() else "Event Player"
+        player = self.registerPlayer()
 
         #if this is a literal, return escape directly
         if not isinstance(array, list):
@@ -973,7 +1842,7 @@ class OverScriptCompiler():
             self._array_build(tos, array[i])
 
         #build next array
-        value = "Empty Array"
+        value = ir.EMPTY_ARRAY
         ind = tos.i - len(array)
         for i in range(len(array)):
             value = self._array_ata("D", value, ind+i, player)
@@ -989,18 +1858,79 @@ class OverScriptCompiler():
         Create a 1-dimensional array using a simpler algorithm
         """
 
-        value = "Empty Array"
+        value = ir.EMPTY_ARRAY
         
         for v in l:
-            value = "Append To Array(%s, %s)" % (value, v)
+            if not isinstance(v, ir.Node):
+                v = ir.Literal(v)
+            value = ir.Value("Append To Array", (value, v))
         return value
 
+    def _array_height(self, array):
+
+        """
+        Returns how deeply lists are nested in array, 0 if it isn't a list.
+        """
+
+        if not isinstance(array, list):
+            return 0
+        return 1 + max(map(self._array_height, array), default=0)
+
+    def _array_assemble(self, array, height, player=None):
+
+        """
+        Assemble an n dimensional array of the specified height
+        and return the variable it was assembled in.
+        """
+
+        #Append To Array flattens arrays, so the only way to nest them is storing
+        #them at an index of a variable. Arrays which only contain values are
+        #built as a single value, every other array is assembled in the variable
+        #for its height, from which its parent copies it once it is done.
+        target = self.ARRAY_ASSEMBLY_VARS[height - 2]
+        leading = 0
+        while leading < len(array) and not isinstance(array[leading], list):
+            leading += 1
+        self._array_set(target, self._create_1d_array(array[:leading]), player)
+        for i in range(leading, len(array)):
+            value = array[i]
+            h = self._array_height(value)
+            if h == 1:
+                value = self._create_1d_array(value)
+            elif h > 1:
+                value = ir.Variable(self._array_assemble(value, h, player), None, player)
+            elif not isinstance(value, ir.Node):
+                value = ir.Literal(value)
+            self.addAction(ir.SetVariable(target, i, value, player))
+        return target
+
+    def _create_nd_array(self, l):
+
+        """
+        Create an n-dimensional array, using as few actions as possible
+        """
+
+        player = self.registerPlayer()
+        height = self._array_height(l)
+        with self._phase("array assembly"):
+            if height - 2 < len(self.ARRAY_ASSEMBLY_VARS):
+                return ir.Variable(self._array_assemble(l, height, player), None, player)
+
+            #too deeply nested, fall back to the array assembly stack
+            #NOTE: I'm using TOS as a wrapper class to get mutable
+            #integers. This could be done with just normal integers
+            #by returning the stack offsets and then calculating the
+            #new one based on that but I couldn't be bothered
+            self._array_build(TOS(), l)
+
+        return ir.Value("Value In Array", (ir.Variable(self.VS_AAS, 0, player), ir.Literal(0)))
+
     def _parseArray(self, node, parse_array=True):
 
         """
         Create an array from a literal.
         if parse_array is True, this will parse the array into a
-        value string and return it. Otherwise, the Python list
+        value node and return it. Otherwise, the Python list
         object will be returned instead.
         """
 
@@ -1018,12 +1948,4 @@ class OverScriptCompiler():
             return self._create_1d_array(l)
 
         #n dimensional array
-        #NOTE: I'm using TOS as a wrapper class to get mutable
-        #integers. This could be done with just normal integers
-        #by returning the stack offsets and then calculating the
-        #new one based on that but I couldn't be bothered
-        self._array_build(TOS(), l)
-
-        if self._currentRule.isGlobal():
-            return "Value In Array(Value In Array(Global Variable(D), 0), 0)"
-        return "Value In Array(Value In Array(Player Variable(Event Player, D), 0), 0)"
+        return self._create_nd_array(l)
@@ -0,0 +1,487 @@
+#Intermediate representation for Overwatch Workshop code
+#
+#The compiler builds rules out of the node types defined here instead of
+#formatting workshop code directly. Values form trees, actions are stored in
+#flat lists per rule. Jumps refer to symbolic labels placed inside these lists,
+#which are resolved to action offsets only when the rule is serialized.
+#This allows optimization passes to insert, remove and rewrite actions without
+#having to fix up any offsets themselves.
+
+#Copyright (c) 2019 fredi_68
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+class RenderContext():
+
+    """
+    State needed to render offsets while serializing an action list.
+    """
+
+    __slots__ = ("positions", "index")
+
+    def __init__(self, positions):
+
+        self.positions = positions
+        self.index = 0
+
+class Node():
+
+    """
+    Base class for all IR nodes.
+    """
+
+    __slots__ = ()
+
+    def children(self):
+
+        """
+        Returns a tuple of all value nodes directly below this node.
+        """
+
+        return ()
+
+    def rebuild(self, children):
+
+        """
+        Returns a copy of this node using children in place of the
+        nodes returned by children(). Nodes are never modified in place
+        by optimization passes, since subtrees may be shared.
+        """
+
+        return self
+
+    def ownElements(self):
+
+        """
+        Returns the number of workshop elements used by this node,
+        excluding its children.
+        """
+
+        return 1
+
+    def elements(self):
+
+        """
+        Returns the number of workshop elements used by this node and its children.
+        This is what counts towards the element limit of the workshop.
+        """
+
+        n = self.ownElements()
+        for child in self.children():
+            n += child.elements()
+        return n
+
+    def render(self, ctx):
+
+        """
+        Returns the workshop code for this node.
+        ctx is the RenderContext of the action list being serialized,
+        or None when rendering outside of an action list.
+        """
+
+        raise NotImplementedError
+
+    def __str__(self):
+
+        return self.render(None)
+
+    def __repr__(self):
+
+        return "<%s %s>" % (self.__class__.__name__, str(self))
+
+#======================
+#VALUES
+#======================
+
+class Literal(Node):
+
+    """
+    A literal value such as a number, a boolean or a raw token.
+    value holds the Python object and is rendered using str().
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+
+        self.value = value
+
+    def render(self, ctx):
+
+        return str(self.value)
+
+class Value(Node):
+
+    """
+    A workshop value.
+    args is a tuple of argument nodes, or None for values
+    that are written without parentheses (e.g. Event Player).
+    """
+
+    __slots__ = ("name", "args")
+
+    def __init__(self, name, args=None):
+
+        self.name = name
+        self.args = args
+
+    def children(self):
+
+        return self.args or ()
+
+    def rebuild(self, children):
+
+        if self.args is None:
+            return self
+        return Value(self.name, tuple(children))
+
+    def render(self, ctx):
+
+        args = self.args
+        if args is None:
+            return self.name
+        return self.name + "(" + ", ".join([arg.render(ctx) for arg in args]) + ")"
+
+class Variable(Node):
+
+    """
+    Read access to a workshop variable.
+
+    var is the workshop variable (a letter). If index is not None,
+    the variable is treated as an array and the element at index is read.
+    player is the node of the player owning the variable, or None for
+    global variables. name is the name of the OverScript variable stored
+    here, or None for variables used internally by the compiler.
+    """
+
+    __slots__ = ("var", "index", "player", "name")
+
+    def __init__(self, var, index=None, player=None, name=None):
+
+        self.var = var
+        self.index = index
+        self.player = player
+        self.name = name
+
+    def children(self):
+
+        return () if self.player is None else (self.player,)
+
+    def rebuild(self, children):
+
+        if self.player is None:
+            return self
+        return Variable(self.var, self.index, children[0], self.name)
+
+    def relocate(self, var, index=None):
+
+        """
+        Returns a copy of this node accessing index of var instead.
+        """
+
+        return Variable(var, index, self.player, self.name)
+
+    def ownElements(self):
+
+        #Global Variable, plus Value In Array and the index
+        return 1 if self.index is None else 3
+
+    def render(self, ctx):
+
+        if self.player is None:
+            value = "Global Variable(%s)" % self.var
+        else:
+            value = "Player Variable(%s, %s)" % (self.player.render(ctx), self.var)
+        if self.index is None:
+            return value
+        return "Value In Array(%s, %i)" % (value, self.index)
+
+class Offset(Node):
+
+    """
+    Distance between two positions in an action list.
+
+    If anchor is None, this is the number of actions between the action
+    containing this node and label, suitable for Skip and Skip If.
+    Otherwise, it is the number of actions between anchor and label.
+    """
+
+    __slots__ = ("label", "anchor")
+
+    def __init__(self, label, anchor=None):
+
+        self.label = label
+        self.anchor = anchor
+
+    def render(self, ctx):
+
+        if ctx is None:
+            return "<%s>" % self.label.name
+        target = ctx.positions[self.label]
+        if self.anchor is None:
+            return str(target - ctx.index - 1)
+        return str(target - ctx.positions[self.anchor])
+
+class Condition(Node):
+
+    """
+    A rule condition comparing two values.
+    """
+
+    __slots__ = ("left", "op", "right")
+
+    def __init__(self, left, op, right):
+
+        self.left = left
+        self.op = op
+        self.right = right
+
+    def children(self):
+
+        return (self.left, self.right)
+
+    def rebuild(self, children):
+
+        return Condition(children[0], self.op, children[1])
+
+    def ownElements(self):
+
+        return 0
+
+    def render(self, ctx):
+
+        return "%s %s %s" % (self.left.render(ctx), self.op, self.right.render(ctx))
+
+#======================
+#ACTIONS
+#======================
+
+class Label(Node):
+
+    """
+    Marks a position in an action list.
+    Labels are not actions themselves and produce no output.
+    """
+
+    __slots__ = ("name",)
+
+    def __init__(self, name="label"):
+
+        self.name = name
+
+    def ownElements(self):
+
+        return 0
+
+    def render(self, ctx):
+
+        return ""
+
+class Action(Node):
+
+    """
+    A workshop action.
+    value is the node describing the action, usually a Value.
+    comment is appended to the action when it is rendered.
+    """
+
+    __slots__ = ("value", "comment")
+
+    def __init__(self, value, comment=""):
+
+        self.value = value
+        self.comment = comment
+
+    @property
+    def name(self):
+
+        """
+        The name of the action, or None if it isn't a Value.
+        """
+
+        return self.value.name if self.value.__class__ is Value else None
+
+    def children(self):
+
+        return (self.value,)
+
+    def rebuild(self, children):
+
+        return Action(children[0], self.comment)
+
+    def ownElements(self):
+
+        #the action itself is its value
+        return 0
+
+    def render(self, ctx):
+
+        code = self.value.render(ctx) + ";"
+        if self.comment:
+            code += " //" + self.comment
+        return code
+
+class SetVariable(Action):
+
+    """
+    Write access to a workshop variable.
+    var, index, player and name have the same meaning as for Variable,
+    value is the node of the value being stored.
+    """
+
+    __slots__ = ("var", "index", "player", "name")
+
+    def __init__(self, var, index, value, player=None, name=None, comment=""):
+
+        super().__init__(value, comment)
+        self.var = var
+        self.index = index
+        self.player = player
+        self.name = name
+
+    def children(self):
+
+        if self.player is None:
+            return (self.value,)
+        return (self.value, self.player)
+
+    def rebuild(self, children):
+
+        player = children[1] if self.player is not None else None
+        return SetVariable(self.var, self.index, children[0], player, self.name, self.comment)
+
+    def relocate(self, var, index=None):
+
+        """
+        Returns a copy of this action writing to index of var instead.
+        """
+
+        return SetVariable(var, index, self.value, self.player, self.name, self.comment)
+
+    def ownElements(self):
+
+        return 1 if self.index is None else 2
+
+    def target(self):
+
+        """
+        Returns a Variable node reading the value written by this action.
+        """
+
+        return Variable(self.var, self.index, self.player, self.name)
+
+    def render(self, ctx):
+
+        value = self.value.render(ctx)
+        if self.player is None:
+            if self.index is None:
+                code = "Set Global Variable(%s, %s);" % (self.var, value)
+            else:
+                code = "Set Global Variable At Index(%s, %i, %s);" % (self.var, self.index, value)
+        else:
+            player = self.player.render(ctx)
+            if self.index is None:
+                code = "Set Player Variable(%s, %s, %s);" % (player, self.var, value)
+            else:
+                code = "Set Player Variable At Index(%s, %s, %i, %s);" % (player, self.var, self.index, value)
+        if self.comment:
+            code += " //" + self.comment
+        return code
+
+class ModifyVariable(SetVariable):
+
+    """
+    Modification of a workshop variable.
+    operation is the name of the workshop operation (e.g. Add),
+    value the node of the operand.
+    """
+
+    __slots__ = ("operation",)
+
+    def __init__(self, var, index, operation, value, player=None, name=None, comment=""):
+
+        super().__init__(var, index, value, player, name, comment)
+        self.operation = operation
+
+    def rebuild(self, children):
+
+        player = children[1] if self.player is not None else None
+        return ModifyVariable(self.var, self.index, self.operation, children[0], player, self.name, self.comment)
+
+    def relocate(self, var, index=None):
+
+        return ModifyVariable(var, index, self.operation, self.value, self.player, self.name, self.comment)
+
+    def ownElements(self):
+
+        #the operation is an element of its own
+        return 2 if self.index is None else 3
+
+    def render(self, ctx):
+
+        value = self.value.render(ctx)
+        if self.player is None:
+            if self.index is None:
+                code = "Modify Global Variable(%s, %s, %s);" % (self.var, self.operation, value)
+            else:
+                code = "Modify Global Variable At Index(%s, %i, %s, %s);" % (self.var, self.index, self.operation, value)
+        else:
+            player = self.player.render(ctx)
+            if self.index is None:
+                code = "Modify Player Variable(%s, %s, %s, %s);" % (player, self.var, self.operation, value)
+            else:
+                code = "Modify Player Variable At Index(%s, %s, %i, %s, %s);" % (player, self.var, self.index, self.operation, value)
+        if self.comment:
+            code += " //" + self.comment
+        return code
+
+#======================
+#HELPERS
+#======================
+
+def serialize(actions):
+
+    """
+    Render an action list into a list of lines of workshop code,
+    resolving all labels.
+    """
+
+    positions = {}
+    n = 0
+    for action in actions:
+        if action.__class__ is Label:
+            positions[action] = n
+        else:
+            n += 1
+
+    ctx = RenderContext(positions)
+    lines = []
+    for action in actions:
+        if action.__class__ is Label:
+            continue
+        ctx.index = len(lines)
+        lines.append(action.render(ctx))
+    return lines
+
+NULL = Value("null")
+TRUE = Value("True")
+FALSE = Value("False")
+EMPTY_ARRAY = Value("Empty Array")
+EVENT_PLAYER = Value("Event Player")
+IGNORE_CONDITION = Value("Ignore Condition")
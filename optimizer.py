@@ -0,0 +1,1353 @@
+﻿#Optimizations for the OverScript compiler
+#
+#All optimizations operate on the IR built by the compiler (see ir.py).
+#They never modify nodes in place, since subtrees may be shared.
+#Optimizations applied to entire rules are implemented as passes, which
+#are functions taking the compiler and the list of all rules of the script.
+#Passes replace rule.conditions and rule.actions with their optimized versions.
+
+#Copyright (c) 2019 fredi_68
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import collections
+import operator
+
+import ir
+
+#======================
+#CONSTANT FOLDING
+#======================
+
+#Vectors which have a workshop value of their own
+DIRECTIONS = {
+    (0, 1, 0): "Up",
+    (0, -1, 0): "Down",
+    (1, 0, 0): "Left",
+    (-1, 0, 0): "Right",
+    (0, 0, 1): "Forward",
+    (0, 0, -1): "Backward"
+    }
+
+COMPARISONS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge
+    }
+
+#Largest exponent folded by Raise To Power
+MAX_EXPONENT = 64
+
+def number(node):
+
+    """
+    Returns the value of node if it is a numeric literal, None otherwise.
+    """
+
+    if node.__class__ is ir.Literal:
+        value = node.value
+        if value.__class__ is int or value.__class__ is float:
+            return value
+    return None
+
+def boolean(node):
+
+    """
+    Returns the value of node if it is a boolean constant, None otherwise.
+    """
+
+    if node.__class__ is ir.Literal:
+        if node.value.__class__ is bool:
+            return node.value
+    elif node.__class__ is ir.Value and node.args is None:
+        if node.name == "True":
+            return True
+        if node.name == "False":
+            return False
+    return None
+
+def makeNumber(value):
+
+    """
+    Returns a literal for the number value.
+    Floats are rounded to 12 significant digits, so the rounding errors of
+    folded arithmetic (0.1 + 0.2 = 0.30000000000000004) don't end up in the output.
+    Integral floats are turned into integers so they render without a fraction.
+    """
+
+    if value.__class__ is float:
+        value = float("%.12g" % value)
+        if value.is_integer() and abs(value) < 2 ** 53:
+            value = int(value)
+    return ir.Literal(value)
+
+def makeBoolean(value):
+
+    return ir.TRUE if value else ir.FALSE
+
+def _foldAdd(args):
+
+    a, b = map(number, args)
+    if a is not None and b is not None:
+        return makeNumber(a + b)
+    if b == 0:
+        return args[0]
+    if a == 0:
+        return args[1]
+    return None
+
+def _foldSubtract(args):
+
+    a, b = map(number, args)
+    if a is not None and b is not None:
+        return makeNumber(a - b)
+    if b == 0:
+        return args[0]
+    return None
+
+def _foldMultiply(args):
+
+    a, b = map(number, args)
+    if a is not None and b is not None:
+        return makeNumber(a * b)
+    if b == 1:
+        return args[0]
+    if a == 1:
+        return args[1]
+    return None
+
+def _foldDivide(args):
+
+    a, b = map(number, args)
+    if b == 1:
+        return args[0]
+    if a is not None and b: #the workshop defines division by zero, leave it to the game
+        return makeNumber(a / b)
+    return None
+
+def _foldModulo(args):
+
+    a, b = map(number, args)
+    #Python and the workshop may disagree on the sign of the result
+    if a is not None and b is not None and a >= 0 and b > 0:
+        return makeNumber(a % b)
+    return None
+
+def _foldPower(args):
+
+    a, b = map(number, args)
+    if b == 1:
+        return args[0]
+    if a is None or b is None or abs(b) > MAX_EXPONENT:
+        return None
+    try:
+        value = a ** b
+    except (OverflowError, ZeroDivisionError):
+        return None
+    if value.__class__ is int or value.__class__ is float:
+        return makeNumber(value)
+    return None #complex
+
+def _foldAbsolute(args):
+
+    a = number(args[0])
+    if a is not None:
+        return makeNumber(abs(a))
+    return None
+
+def _foldCompare(args):
+
+    a = number(args[0])
+    b = number(args[2])
+    if args[1].__class__ is not ir.Literal:
+        return None
+    op = COMPARISONS.get(args[1].value)
+    if op is None:
+        return None
+    if a is not None and b is not None:
+        return makeBoolean(op(a, b))
+    if op is operator.eq or op is operator.ne:
+        a = boolean(args[0])
+        b = boolean(args[2])
+        if a is not None and b is not None:
+            return makeBoolean(op(a, b))
+    return None
+
+def _foldNot(args):
+
+    x = args[0]
+    a = boolean(x)
+    if a is not None:
+        return makeBoolean(not a)
+    #Not(Not(x)) only shows up in conditions, where x is used as a boolean anyway
+    if x.__class__ is ir.Value and x.name == "Not" and x.args:
+        return x.args[0]
+    return None
+
+def _foldAnd(args):
+
+    a, b = map(boolean, args)
+    if a is False or b is False:
+        return ir.FALSE
+    if a is True and b is True:
+        return ir.TRUE
+    return None
+
+def _foldOr(args):
+
+    a, b = map(boolean, args)
+    if a is True or b is True:
+        return ir.TRUE
+    if a is False and b is False:
+        return ir.FALSE
+    return None
+
+def _foldVector(args):
+
+    components = tuple(map(number, args))
+    if components in DIRECTIONS:
+        return ir.Value(DIRECTIONS[components])
+    return None
+
+#Folding functions by workshop value name, with the number of arguments they expect.
+#Each function takes the argument nodes of a value and returns
+#the node replacing it, or None if the value can't be folded.
+FOLDERS = {
+    "Add": (2, _foldAdd),
+    "Subtract": (2, _foldSubtract),
+    "Multiply": (2, _foldMultiply),
+    "Divide": (2, _foldDivide),
+    "Modulo": (2, _foldModulo),
+    "Raise To Power": (2, _foldPower),
+    "Absolute Value": (1, _foldAbsolute),
+    "Compare": (3, _foldCompare),
+    "Not": (1, _foldNot),
+    "And": (2, _foldAnd),
+    "Or": (2, _foldOr),
+    "Vector": (3, _foldVector)
+    }
+
+def foldValue(node):
+
+    """
+    Evaluate node if it is a constant expression and apply algebraic
+    identities. The arguments of node must already be folded, so
+    folding every value as it is built folds the whole tree.
+    Returns the simplified node.
+    """
+
+    if node.__class__ is ir.Value and node.args:
+        entry = FOLDERS.get(node.name)
+        if entry is not None and len(node.args) == entry[0]:
+            folded = entry[1](node.args)
+            if folded is not None:
+                return folded
+    return node
+
+#Values which are the same wherever and whenever they are evaluated,
+#as long as their arguments are
+CONSTANT_VALUES = frozenset((
+    "Add",
+    "Append To Array",
+    "Divide",
+    "Empty Array",
+    "False",
+    "Hero",
+    "Multiply",
+    "null",
+    "String",
+    "Subtract",
+    "Team",
+    "True",
+    "Vector",
+    *DIRECTIONS.values()
+    ))
+
+def isConstant(node):
+
+    """
+    Check whether node always evaluates to the same value.
+    """
+
+    if node.__class__ is ir.Literal:
+        return True
+    if node.__class__ is not ir.Value or node.name not in CONSTANT_VALUES:
+        return False
+    for child in node.children():
+        if not isConstant(child):
+            return False
+    return True
+
+#======================
+#DEAD CODE ELIMINATION
+#======================
+
+#Actions after which execution never continues with the next action
+TERMINATORS = frozenset(("Loop", "Abort"))
+#Actions jumping forward by a number of actions
+JUMPS = frozenset(("Skip", "Skip If"))
+#Actions starting a loop, which ends with the matching End action
+LOOPS = frozenset(("While",))
+
+def _jumpTarget(action):
+
+    """
+    Returns the label action jumps to, if it is a Skip or Skip If
+    with a known target. Returns None otherwise.
+    """
+
+    value = action.value
+    if value.__class__ is ir.Value and value.name in JUMPS:
+        offset = value.args[-1]
+        if offset.__class__ is ir.Offset and offset.anchor is None:
+            return offset.label
+    return None
+
+def _terminates(action):
+
+    """
+    Check whether execution never continues after action.
+    """
+
+    value = action.value
+    if value.__class__ is not ir.Value:
+        return False
+    if value.name in TERMINATORS:
+        return True
+    return value.name == "Skip" and _jumpTarget(action) is not None
+
+def _foldSkip(action):
+
+    """
+    Returns action with a constant Skip If condition resolved.
+    Returns None if the action never does anything.
+    """
+
+    value = action.value
+    if value.__class__ is ir.Value and value.name == "Skip If":
+        condition = boolean(value.args[0])
+        if condition is False:
+            return None
+        if condition is True:
+            return ir.Action(ir.Value("Skip", value.args[1:]), action.comment)
+    return action
+
+def _labelsUsed(actions):
+
+    """
+    Returns the set of labels referred to by offsets in actions.
+    Offsets are only ever used directly as values or arguments of actions.
+    """
+
+    offsets = []
+    for action in actions:
+        if action.__class__ is ir.Label:
+            continue
+        value = action.value
+        if value.__class__ is ir.Offset:
+            offsets.append(value)
+        elif value.__class__ is ir.Value and value.args:
+            offsets.extend([node for node in value.args if node.__class__ is ir.Offset])
+
+    labels = set()
+    for offset in offsets:
+        labels.add(offset.label)
+        if offset.anchor is not None:
+            labels.add(offset.anchor)
+    return labels
+
+def _jumpsPast(actions, i, j):
+
+    """
+    Check whether the action at index i only jumps to the action following index j.
+    """
+
+    target = _jumpTarget(actions[i])
+    if target is None:
+        return False
+    for action in actions[j+1:]:
+        if action is target:
+            return True
+        if action.__class__ is not ir.Label:
+            return False
+    return False
+
+def _jumpsToNext(actions, i):
+
+    """
+    Check whether the action at index i only jumps to the action following it.
+    """
+
+    return _jumpsPast(actions, i, i)
+
+def _matchLoops(actions):
+
+    """
+    Returns a dictionary mapping the indices of all loop starts in actions
+    to the indices of their End actions and vice versa.
+    """
+
+    matches = {}
+    starts = []
+    for i, action in enumerate(actions):
+        if action.__class__ is ir.Label:
+            continue
+        name = action.name
+        if name in LOOPS:
+            starts.append(i)
+        elif name == "End":
+            start = starts.pop()
+            matches[start] = i
+            matches[i] = start
+    return matches
+
+def removeDeadLoops(actions):
+
+    """
+    Returns actions without all loops whose condition is constant false.
+    """
+
+    ends = _matchLoops(actions)
+    result = []
+    i = 0
+    while i < len(actions):
+        action = actions[i]
+        if action.__class__ is not ir.Label and action.name in LOOPS and boolean(action.value.args[0]) is False:
+            i = ends[i] + 1
+            continue
+        result.append(action)
+        i += 1
+    return result
+
+def removeUnreachableCode(actions):
+
+    """
+    Returns actions without all actions that can never be executed.
+
+    An action is unreachable if it follows an action execution never continues
+    after, unless there is a label in between that is jumped to. Skip If actions
+    with constant conditions and jumps to the next action are resolved first,
+    which may make more code unreachable. Labels are always kept.
+    """
+
+    actions = [action if action.__class__ is ir.Label else _foldSkip(action) for action in actions]
+    actions = [action for action in actions if action is not None]
+    while True:
+        targets = _labelsUsed(actions)
+        result = []
+        reachable = True
+        for i, action in enumerate(actions):
+            if action.__class__ is ir.Label:
+                reachable = reachable or action in targets
+                result.append(action)
+            elif reachable:
+                if action.name in JUMPS and _jumpsToNext(actions, i):
+                    continue
+                result.append(action)
+                reachable = not _terminates(action)
+        if len(result) == len(actions):
+            return result
+        actions = result
+
+def removeDeadStores(actions, var, live):
+
+    """
+    Returns actions without all assignments to named variables stored in var
+    which are never read. live is the set of (isGlobal, name) tuples of all
+    variables that are read.
+    """
+
+    result = []
+    for action in actions:
+        if isinstance(action, ir.SetVariable) and action.var == var and action.name is not None:
+            if not (action.player is None, action.name) in live:
+                continue
+        result.append(action)
+    return result
+
+def removeLoopBranches(actions, entry, var):
+
+    """
+    Returns actions without the loop branch actions stored in var,
+    if there are no loops left. The branch at the start of the rule
+    is placed before the label entry.
+    """
+
+    for action in actions:
+        if action.__class__ is not ir.Label and action.name == "Loop":
+            return actions
+    actions = actions[actions.index(entry):]
+    return [action for action in actions if not (isinstance(action, ir.SetVariable) and action.var == var)]
+
+def eliminateDeadCode(compiler, rules):
+
+    """
+    Dead code elimination pass.
+    """
+
+    for rule in rules:
+        before = rule.actions
+        actions = removeDeadStores(before, compiler.VS_VAR, compiler.read_var_names)
+        actions = removeDeadLoops(actions)
+        actions = removeUnreachableCode(actions)
+        if rule.loopCount:
+            actions = removeLoopBranches(actions, rule.entry, compiler.VS_LBS)
+        #labels nothing jumps to only keep other optimizations from merging actions
+        used = _labelsUsed(actions)
+        actions = [action for action in actions if action.__class__ is not ir.Label or action in used or action is rule.entry]
+        rule.actions = actions
+
+        removed = sum(1 for action in before if action.__class__ is not ir.Label) - sum(1 for action in actions if action.__class__ is not ir.Label)
+        if removed:
+            kept = set(map(id, actions))
+            elements = sum(action.elements() for action in before if not id(action) in kept)
+            #some actions were replaced rather than removed
+            kept = set(map(id, before))
+            elements -= sum(action.elements() for action in actions if not id(action) in kept)
+            compiler.logger.info("Removed %i dead actions (%i elements) from rule '%s'.", removed, elements, rule.name)
+
+#======================
+#REGISTER ALLOCATION
+#======================
+
+#Factor by which accesses inside a loop are weighted over accesses outside of it
+LOOP_WEIGHT = 8
+
+def _loopHeads(actions):
+
+    """
+    Returns the set of labels loops in actions start at.
+    These are the labels the loop branch state refers to.
+    """
+
+    heads = set()
+    for action in actions:
+        if isinstance(action, ir.SetVariable) and action.value.__class__ is ir.Offset and action.value.anchor is not None:
+            heads.add(action.value.label)
+    return heads
+
+def _isEventPlayer(node):
+
+    return node.__class__ is ir.Value and node.name == "Event Player" and node.args is None
+
+class RegisterAllocator():
+
+    """
+    Moves the most frequently used variables out of the variable array
+    into workshop variables of their own, and packs the remaining
+    variables into as few array slots as possible.
+
+    Reading a variable stored in the array takes three elements, writing it
+    takes two. A variable of its own only takes one element for either.
+    Accesses are counted over the whole script, weighted by the loop nesting
+    depth they occur at. Global and player variables are allocated separately,
+    since every workshop variable exists once globally and once per player.
+
+    Variables left in the array share slots if their lifetimes never overlap.
+    Rules only ever run one at a time until they wait, so a variable which
+    is always assigned before it is read and never holds a value across a
+    Wait (or a Loop, which waits as well) or a subroutine call is temporary:
+    it can only interfere with variables of the same rule. All other variables
+    are persistent and get a slot of their own. So are player variables accessed
+    through any player but the event player, since only the event player's
+    copy can be tracked.
+    """
+
+    def __init__(self, var, free):
+
+        """
+        var is the variable holding the variable array, free
+        the list of workshop variables available for allocation.
+        """
+
+        self.var = var
+        self.free = free
+        self.weights = collections.Counter()
+        self.reserved = set()
+        self.registers = {}
+        self.slots = {}
+        self.persistent = set()
+        #(rule, accesses) for every rule, see count()
+        self.accesses = []
+
+    def _count(self, node, weight, uses):
+
+        cls = node.__class__
+        if cls is ir.Literal:
+            return
+        if cls is ir.Variable or cls is ir.SetVariable or cls is ir.ModifyVariable:
+            if node.var == self.var and node.name is not None:
+                key = (node.player is None, node.name)
+                self.weights[key] += weight
+                if cls is not ir.SetVariable:
+                    uses.add(key)
+                if node.player is not None and not _isEventPlayer(node.player):
+                    #liveness only follows the copy of the event player,
+                    #the copies of other players may be accessed at any time
+                    self.persistent.add(key)
+            else:
+                #workshop variables accessed by the script directly
+                self.reserved.add(node.var)
+        for child in node.children():
+            self._count(child, weight, uses)
+
+    def count(self, rule):
+
+        """
+        Count the variable accesses in rule.
+        """
+
+        #loops built from Loop actions start at a loop head and end with the Loop action
+        heads = _loopHeads(rule.actions)
+
+        #the variables read and the variable assigned by every action, None for labels
+        accesses = []
+        depth = 0
+        for action in rule.actions:
+            if action.__class__ is ir.Label:
+                if action in heads:
+                    depth += 1
+                accesses.append(None)
+                continue
+            name = action.name
+            if name in LOOPS:
+                #the loop condition is checked on every iteration
+                depth += 1
+            uses = set()
+            self._count(action, LOOP_WEIGHT ** depth, uses)
+            definition = None
+            if isinstance(action, ir.SetVariable) and action.var == self.var and action.name is not None:
+                definition = (action.player is None, action.name)
+            accesses.append((uses, definition))
+            if name == "Loop" or name == "End":
+                depth = max(depth - 1, 0)
+        self.accesses.append((rule, accesses))
+
+        #conditions may be checked at any time
+        for condition in rule.conditions:
+            self._count(condition, 1, self.persistent)
+
+    def allocate(self):
+
+        """
+        Assign workshop variables to the most frequently used variables.
+        Returns a dictionary mapping (isGlobal, name) tuples to workshop variables.
+        """
+
+        free = [var for var in self.free if not var in self.reserved]
+        ranked = sorted(self.weights, key=lambda key: (-self.weights[key], key))
+        for isGlobal in (True, False):
+            candidates = [key for key in ranked if key[0] == isGlobal]
+            self.registers.update(zip(candidates, free))
+        return self.registers
+
+    def _successors(self, rule):
+
+        """
+        Returns the indices of the items execution may continue with
+        after every item of the actions of rule. len(rule.actions)
+        is the end of the rule.
+        """
+
+        actions = rule.actions
+        positions = {action: i for i, action in enumerate(actions) if action.__class__ is ir.Label}
+        heads = tuple([positions[rule.entry]] + [positions[head] for head in _loopHeads(actions)])
+        loops = _matchLoops(actions)
+
+        successors = []
+        for i, action in enumerate(actions):
+            if action.__class__ is ir.Label:
+                successors.append((i + 1,))
+                continue
+            name = action.name
+            target = _jumpTarget(action)
+            if name == "Loop":
+                #Loop starts over, the loop branch then skips to one of the loop heads
+                successors.append((0,))
+            elif name in LOOPS:
+                successors.append((i + 1, loops[i] + 1))
+            elif name == "End":
+                successors.append((loops[i],))
+            elif target is not None:
+                if name == "Skip":
+                    successors.append((positions[target],))
+                else:
+                    successors.append((positions[target], i + 1))
+            elif name == "Skip":
+                #the loop branch
+                successors.append(heads)
+            elif name in TERMINATORS:
+                successors.append(())
+            else:
+                successors.append((i + 1,))
+        return successors
+
+    def _interferences(self, rule, accesses, graph):
+
+        """
+        Run liveness analysis on rule, adding interferences between
+        variables to graph and marking persistent variables.
+        """
+
+        actions = rule.actions
+        successors = self._successors(rule)
+        live = [_NO_READS] * (len(actions) + 1)
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(actions) - 1, -1, -1):
+                out = _NO_READS
+                for j in successors[i]:
+                    out = out | live[j]
+                access = accesses[i]
+                if access is not None:
+                    uses, definition = access
+                    if definition is not None:
+                        out = out - {definition}
+                    out = out | uses
+                if out != live[i]:
+                    live[i] = out
+                    changed = True
+
+        #values live at the start of the rule are kept from earlier runs
+        self.persistent.update(live[0])
+        for i, action in enumerate(actions):
+            access = accesses[i]
+            if access is None:
+                continue
+            out = _NO_READS
+            for j in successors[i]:
+                out = out | live[j]
+            name = action.name
+            #subroutines may wait, and use slots of their own temporaries
+            if name is not None and (name.startswith("Wait") or name == "Call Subroutine"):
+                self.persistent.update(out)
+            definition = access[1]
+            if definition is not None:
+                for key in out:
+                    if key != definition:
+                        graph[definition].add(key)
+                        graph[key].add(definition)
+
+    def pack(self):
+
+        """
+        Assign array slots to all variables which didn't get a workshop
+        variable of their own. Returns a dictionary mapping
+        (isGlobal, name) tuples to slots.
+        """
+
+        spilled = set(self.weights) - set(self.registers)
+        graph = {key: set() for key in spilled}
+        for rule, accesses in self.accesses:
+            #only spilled variables need slots
+            accesses = [None if access is None else (access[0] & spilled, access[1] if access[1] in spilled else None) for access in accesses]
+            if any(access is not None and (access[0] or access[1] is not None) for access in accesses):
+                self._interferences(rule, accesses, graph)
+
+        for isGlobal in (True, False):
+            keys = [key for key in spilled if key[0] == isGlobal]
+            persistent = sorted((key for key in keys if key in self.persistent), key=lambda key: (-self.weights[key], key))
+            for slot, key in enumerate(persistent):
+                self.slots[key] = slot
+            #greedy coloring of the temporaries, most constrained first
+            temporaries = sorted((key for key in keys if not key in self.persistent), key=lambda key: (-len(graph[key]), key))
+            for key in temporaries:
+                taken = set(self.slots.get(other) for other in graph[key])
+                slot = len(persistent)
+                while slot in taken:
+                    slot += 1
+                self.slots[key] = slot
+        return self.slots
+
+    def _rewrite(self, node):
+
+        cls = node.__class__
+        if cls is ir.Literal:
+            return node
+        children = node.children()
+        if children:
+            rewrite = self._rewrite
+            new = tuple([rewrite(child) for child in children])
+            #nodes only compare equal if they are the same node
+            if new != children:
+                node = node.rebuild(new)
+
+        if cls is ir.Variable or cls is ir.SetVariable or cls is ir.ModifyVariable:
+            if node.var == self.var and node.name is not None:
+                key = (node.player is None, node.name)
+                register = self.registers.get(key)
+                if register is not None:
+                    return node.relocate(register)
+                slot = self.slots[key]
+                if slot != node.index:
+                    return node.relocate(self.var, slot)
+        return node
+
+    def rewrite(self, rule):
+
+        """
+        Make rule use the allocated workshop variables and slots.
+        """
+
+        rule.actions = [self._rewrite(action) for action in rule.actions]
+        rule.conditions = [self._rewrite(condition) for condition in rule.conditions]
+
+def allocateRegisters(compiler, rules):
+
+    """
+    Register allocation pass.
+    """
+
+    allocator = RegisterAllocator(compiler.VS_VAR, [var for var in compiler.VARIABLES if not var in compiler.used_vars])
+    for rule in rules:
+        allocator.count(rule)
+    registers = allocator.allocate()
+    for (isGlobal, name), register in sorted(registers.items()):
+        compiler.logger.debug("Allocated %s variable '%s' to %s.", "global" if isGlobal else "player", name, register)
+    slots = allocator.pack()
+    for rule in rules:
+        allocator.rewrite(rule)
+
+    footprint = [max([slot + 1 for key, slot in slots.items() if key[0] == isGlobal], default=0) for isGlobal in (True, False)]
+    compiler.logger.info("Variable array size: %i global and %i player slots before allocation, %i and %i after.",
+        len(compiler.global_var_names), len(compiler.player_var_names), *footprint)
+
+#======================
+#COMMON SUBEXPRESSION ELIMINATION
+#======================
+
+#Values which may return a different result every time they are evaluated
+IMPURE_VALUES = frozenset((
+    "Random Integer",
+    "Random Real",
+    "Random Value In Array",
+    "Randomized Array"
+    ))
+
+#Maximum number of values cached per block
+MAX_TEMPORARIES = 16
+
+_NO_READS = frozenset()
+
+#Description of a numbered value.
+#node is the first node found for the value, children the numbers of its
+#children, reads the set of variables it reads. Only pure values, which
+#always yield the same result as long as the variables they read don't
+#change, are cacheable.
+ValueInfo = collections.namedtuple("ValueInfo", ("node", "children", "elements", "reads", "pure", "cacheable"))
+
+class ValueNumbering():
+
+    """
+    Local value numbering for IR nodes.
+
+    Structurally equal nodes get the same number. For every number,
+    a ValueInfo tuple describing the value is recorded.
+    """
+
+    def __init__(self):
+
+        self.numbers = {}
+        self.nodes = {}
+        self.info = []
+        #numbered nodes are kept alive, so their ids can't be reused
+        self._alive = []
+
+    def number(self, node):
+
+        """
+        Returns the value number of node.
+        """
+
+        vn = self.nodes.get(id(node))
+        if vn is not None:
+            return vn
+
+        cls = node.__class__
+        if cls is ir.Literal:
+            children = ()
+            key = (node.value.__class__, node.value)
+        else:
+            number = self.number
+            children = tuple([number(child) for child in node.children()])
+            if cls is ir.Value:
+                key = (node.name, node.args is None, children)
+            elif cls is ir.Variable:
+                key = (cls, node.var, node.index, children)
+            else:
+                #offsets depend on their position, never treat them as equal
+                key = (cls, id(node))
+
+        vn = self.numbers.get(key)
+        if vn is None:
+            vn = self.numbers[key] = len(self.info)
+            self.info.append(self._describe(node, children))
+
+        self.nodes[id(node)] = vn
+        self._alive.append(node)
+        return vn
+
+    def _describe(self, node, children):
+
+        cls = node.__class__
+        if cls is ir.Literal:
+            return ValueInfo(node, (), 1, _NO_READS, True, False)
+
+        info = self.info
+        elements = node.ownElements()
+        reads = _NO_READS
+        pure = cls is ir.Value or cls is ir.Variable
+        for child in children:
+            child = info[child]
+            elements += child.elements
+            if child.reads:
+                reads = reads | child.reads
+            pure = pure and child.pure
+        if cls is ir.Variable:
+            reads = reads | frozenset((node.var,))
+        elif cls is ir.Value and node.name in IMPURE_VALUES:
+            pure = False
+        #values using a single element are never worth caching
+        return ValueInfo(node, children, elements, reads, pure, pure and elements > 1)
+
+class _Occurrences():
+
+    """
+    Occurrences of a value within a block, during which
+    none of the variables it reads are written to.
+    """
+
+    __slots__ = ("vn", "count", "first", "last")
+
+    def __init__(self, vn, first):
+
+        self.vn = vn
+        self.count = 0
+        self.first = first
+        self.last = first
+
+class CommonSubexpressionEliminator():
+
+    """
+    Caches values used repeatedly within a block of actions in a scratch variable.
+
+    Blocks consist of consecutive variable assignments followed by a single
+    other action and never contain labels or loop starts. This way, cached values can't be
+    skipped over, don't live across waits and can't be affected by actions
+    changing the state of the game. Assigning a variable invalidates all
+    cached values reading it.
+
+    Values are only cached if that saves elements. A single cached value is
+    kept in the scratch variable directly, multiple values are kept in it
+    as an array.
+    """
+
+    def __init__(self, scratch):
+
+        self.scratch = scratch
+        self.numbering = ValueNumbering()
+
+    def _scan(self, actions):
+
+        """
+        Returns a list of the occurrences of all cacheable values in actions.
+        """
+
+        numbering = self.numbering
+        info = numbering.info
+        live = {}
+        found = []
+
+        for i, action in enumerate(actions):
+            stack = [numbering.number(child) for child in action.children()]
+            while stack:
+                vn = stack.pop()
+                value = info[vn]
+                if value.cacheable:
+                    occurrences = live.get(vn)
+                    if occurrences is None:
+                        occurrences = live[vn] = _Occurrences(vn, i)
+                        found.append(occurrences)
+                    occurrences.count += 1
+                    occurrences.last = i
+                stack.extend(value.children)
+            if isinstance(action, ir.SetVariable) and live:
+                var = action.var
+                for vn in [vn for vn in live if var in info[vn].reads]:
+                    del live[vn]
+
+        return found
+
+    def _savings(self, occurrences, plain):
+
+        e = self.numbering.info[occurrences.vn].elements
+        if plain:
+            store, load = 1, 1 #Set Global Variable(G, x) / Global Variable(G)
+        else:
+            store, load = 2, 3 #the same with an index and Value In Array
+        return occurrences.count * e - (store + e + occurrences.count * load)
+
+    def _best(self, found, plain):
+
+        best = None
+        best_savings = 0
+        for occurrences in found:
+            if occurrences.count < 2:
+                continue
+            savings = self._savings(occurrences, plain)
+            if savings > best_savings:
+                best = occurrences
+                best_savings = savings
+        return best, best_savings
+
+    def _replace(self, node, vn, replacement):
+
+        if self.numbering.number(node) == vn:
+            return replacement
+        children = node.children()
+        if not children:
+            return node
+        new = [self._replace(child, vn, replacement) for child in children]
+        for old, child in zip(children, new):
+            if old is not child:
+                return node.rebuild(new)
+        return node
+
+    def _select(self, actions, found, plain):
+
+        """
+        Greedily cache the most profitable values in actions.
+        found is the result of _scan(actions).
+        Returns the number of elements saved and the new action list.
+        """
+
+        actions = list(actions)
+        saved = 0
+        count = 0
+        while count < (1 if plain else MAX_TEMPORARIES):
+            if count:
+                found = self._scan(actions)
+            best, best_savings = self._best(found, plain)
+            if best is None:
+                break
+
+            index = None if plain else count
+            load = ir.Variable(self.scratch, index)
+            for i in range(best.first, best.last + 1):
+                actions[i] = self._replace(actions[i], best.vn, load)
+            actions.insert(best.first, ir.SetVariable(self.scratch, index, self.numbering.info[best.vn].node))
+            saved += best_savings
+            count += 1
+        return saved, actions
+
+    def block(self, actions):
+
+        """
+        Returns the optimized version of the block actions.
+        """
+
+        if not actions:
+            return actions
+        found = self._scan(actions)
+        #caching a single value is always at least as cheap
+        if self._best(found, True)[0] is None:
+            return actions
+
+        plain = self._select(actions, found, True)
+        array = self._select(actions, found, False)
+        return max(plain, array, key=lambda x: x[0])[1]
+
+    def actions(self, actions):
+
+        """
+        Returns the optimized version of the action list of a rule.
+        """
+
+        result = []
+        block = []
+        for action in actions:
+            if action.__class__ is ir.Label:
+                result.extend(self.block(block))
+                result.append(action)
+                block = []
+                continue
+            if action.name in LOOPS:
+                #loops are jumped back to from their end, just like labels
+                result.extend(self.block(block))
+                block = []
+            block.append(action)
+            if not isinstance(action, ir.SetVariable):
+                result.extend(self.block(block))
+                block = []
+        result.extend(self.block(block))
+        return result
+
+def eliminateCommonSubexpressions(compiler, rules):
+
+    """
+    Common subexpression elimination pass.
+    """
+
+    for rule in rules:
+        rule.actions = CommonSubexpressionEliminator(compiler.VS_CSE).actions(rule.actions)
+
+#======================
+#PEEPHOLE OPTIMIZATION
+#======================
+
+#Comparison operators, mapped to their negation
+NEGATED_COMPARISONS = {
+    "==": "!=",
+    "!=": "==",
+    "<": ">=",
+    ">=": "<",
+    ">": "<=",
+    "<=": ">"
+    }
+
+def negateCondition(node):
+
+    """
+    Returns a condition which holds whenever node doesn't and vice versa.
+    """
+
+    if node.__class__ is ir.Value and node.name == "Compare" and node.args:
+        op = node.args[1]
+        if op.__class__ is ir.Literal and op.value in NEGATED_COMPARISONS:
+            return ir.Value("Compare", (node.args[0], ir.Literal(NEGATED_COMPARISONS[op.value]), node.args[2]))
+    return foldValue(ir.Value("Not", (node,)))
+
+def _reads(node, var):
+
+    """
+    Check whether node reads the variable var.
+    """
+
+    if node.__class__ is ir.Variable and node.var == var:
+        return True
+    for child in node.children():
+        if _reads(child, var):
+            return True
+    return False
+
+def _sameSlot(a, b):
+
+    """
+    Check whether the SetVariable actions a and b write to the same variable.
+    """
+
+    if a.var != b.var or a.index != b.index:
+        return False
+    if a.player is None or b.player is None:
+        return a.player is b.player
+    #players are simple values like Event Player, which may be compared by their code
+    return str(a.player) == str(b.player)
+
+class PeepholeOptimizer():
+
+    """
+    Rewrites short sequences of actions into cheaper ones.
+
+    RULES lists the names of the rewrite rules, which are tried in order
+    at every action. A rule is a method taking the action list and the index
+    of an action. If it applies, it returns a tuple (n, replacement), meaning
+    the n items starting at that index are replaced by the list replacement.
+    Otherwise, it returns None. Every rewrite must make the actions cheaper,
+    so the optimizer always terminates.
+
+    Labels may be jumped to, so rules never merge actions across them.
+    Offsets are resolved from labels when the rule is serialized, so they
+    stay correct no matter which actions are removed.
+    """
+
+    RULES = (
+        "_removeEmptySkip",
+        "_removeEmptyElse",
+        "_negateSkipCondition",
+        "_mergeWaits",
+        "_removeOverwrittenSet",
+        "_removeRedundantLoopBranch"
+        )
+
+    #Actions which may use the loop branch state, directly or by ending the rule
+    LOOP_BRANCH_USES = ("Loop", "Abort", "Wait")
+
+    def __init__(self, loopBranch):
+
+        """
+        loopBranch is the variable holding the loop branch state.
+        """
+
+        self.loopBranch = loopBranch
+        self.rules = [getattr(self, name) for name in self.RULES]
+
+    def _removeEmptySkip(self, actions, i):
+
+        #Skip(0), Skip If(x, 0)
+        action = actions[i]
+        if action.name != "Skip" and action.name != "Skip If":
+            return None
+        offset = action.value.args[-1]
+        if _jumpsToNext(actions, i) or (offset.__class__ is ir.Literal and offset.value == 0):
+            return 1, []
+        return None
+
+    def _removeEmptyElse(self, actions, i):
+
+        #Skip If(x, if), Skip(endif), if: -> Skip If(Not(x), endif)
+        action = actions[i]
+        if action.name != "Skip If" or i + 1 >= len(actions):
+            return None
+        skip = actions[i+1]
+        if skip.__class__ is ir.Label or skip.name != "Skip" or _jumpTarget(skip) is None:
+            return None
+        if not _jumpsPast(actions, i, i + 1):
+            return None
+        condition, offset = action.value.args
+        return 2, [ir.Action(ir.Value("Skip If", (negateCondition(condition), skip.value.args[0])), action.comment)]
+
+    def _negateSkipCondition(self, actions, i):
+
+        #Skip If(Not(Compare(a, <, b)), n) -> Skip If(Compare(a, >=, b), n)
+        action = actions[i]
+        if action.name != "Skip If":
+            return None
+        condition, offset = action.value.args
+        if condition.__class__ is not ir.Value or condition.name != "Not" or not condition.args:
+            return None
+        negated = negateCondition(condition.args[0])
+        if negated.__class__ is ir.Value and negated.name == "Not":
+            return None
+        return 1, [ir.Action(ir.Value("Skip If", (negated, offset)), action.comment)]
+
+    def _mergeWaits(self, actions, i):
+
+        #Wait(a, x), Wait(b, x) -> Wait(a + b, x)
+        action = actions[i]
+        if action.name != "Wait" or i + 1 >= len(actions):
+            return None
+        other = actions[i+1]
+        if other.__class__ is ir.Label or other.name != "Wait":
+            return None
+        a, behavior = action.value.args
+        b, otherBehavior = other.value.args
+        a = number(a)
+        b = number(b)
+        if a is None or b is None or str(behavior) != str(otherBehavior):
+            return None
+        return 2, [ir.Action(ir.Value("Wait", (makeNumber(a + b), behavior)), action.comment)]
+
+    def _removeOverwrittenSet(self, actions, i):
+
+        #Set Variable(A, x), Set Variable(A, y) -> Set Variable(A, y)
+        action = actions[i]
+        if not isinstance(action, ir.SetVariable) or i + 1 >= len(actions):
+            return None
+        other = actions[i+1]
+        if other.__class__ is not ir.SetVariable or not _sameSlot(action, other):
+            return None
+        if _reads(other.value, other.var) or (other.player is not None and _reads(other.player, other.var)):
+            return None
+        return 1, []
+
+    def _loopBranchSet(self, actions, i, known):
+
+        """
+        Check whether the loop branch state is set on every path starting
+        at index i, before it may be used. known caches results by index.
+        """
+
+        start = i
+        result = False
+        while i < len(actions):
+            if i in known:
+                result = known[i]
+                break
+            action = actions[i]
+            i += 1
+            if action.__class__ is ir.Label:
+                continue
+            if isinstance(action, ir.SetVariable):
+                if action.var == self.loopBranch:
+                    result = action.__class__ is ir.SetVariable
+                    break
+                continue
+            name = action.name
+            if name is None or name.startswith(self.LOOP_BRANCH_USES):
+                break
+            if name == "Skip" or name == "Skip If":
+                target = _jumpTarget(action)
+                if target is None:
+                    break
+                j = actions.index(target)
+                if j < i or not self._loopBranchSet(actions, j, known):
+                    break
+                if name == "Skip":
+                    result = True
+                    break
+        known[start] = result
+        return result
+
+    def _removeRedundantLoopBranch(self, actions, i):
+
+        #Set Variable(B, x), ..., Set Variable(B, y) -> ..., Set Variable(B, y)
+        action = actions[i]
+        if action.__class__ is not ir.SetVariable or action.var != self.loopBranch:
+            return None
+        if self._loopBranchSet(actions, i + 1, {}):
+            return 1, []
+        return None
+
+    def actions(self, actions):
+
+        """
+        Returns the optimized version of the action list of a rule.
+        """
+
+        actions = list(actions)
+        i = 0
+        while i < len(actions):
+            if actions[i].__class__ is not ir.Label:
+                for rule in self.rules:
+                    match = rule(actions, i)
+                    if match is not None:
+                        n, replacement = match
+                        actions[i:i+n] = replacement
+                        #the rewrite may allow rules to match at the previous action
+                        i = max(i - 1, 0)
+                        break
+                else:
+                    i += 1
+            else:
+                i += 1
+        return actions
+
+def optimizePeephole(compiler, rules):
+
+    """
+    Peephole optimization pass.
+    """
+
+    optimizer = PeepholeOptimizer(compiler.VS_LBS)
+    for rule in rules:
+        rule.actions = optimizer.actions(rule.actions)
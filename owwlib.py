@@ -8,8 +8,8 @@
 #loop and function stacks and already defined rules and actions.
 #The function then may insert an arbitrary amount of actions
 #into the current rule before returning.
-#Each function should return a string specifying the value or
-#action requested for the current context.
+#Each function should return an IR node (see ir.py) specifying
+#the value or action requested for the current context.
 
 #TODO: Extend this to cover all workshop actions and values
 
@@ -33,30 +33,35 @@
 #OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 #SOFTWARE.
 
+import ir as _ir
+
 #make sure to define builtins that we will override
 #so we can still access them later
 _range = __builtins__["range"]
 _input = __builtins__["input"]
 
+def _call(ctx, name, *args):
+    return _ir.Value(name, tuple(map(ctx._parseExpr, args)))
+
 #======================
 #ACTIONS
 #======================
 
 def wait(ctx, time, cond=None):
     if cond is None:
-        cond = "Ignore Condition"
+        cond = _ir.IGNORE_CONDITION
     else:
         cond = ctx._parseExpr(cond)
-    return "Wait(%s, %s)" % (ctx._parseExpr(time), cond)
+    return _ir.Value("Wait", (ctx._parseExpr(time), cond))
 
 def appendToArray(ctx, array, element):
-    return "Append To Array(%s, %s)" % (ctx._parseExpr(array), ctx._parseExpr(element))
+    return _call(ctx, "Append To Array", array, element)
 
 def applyImpulse(ctx, player, direction, speed, relative, motion):
-    return "Apply Impulse(%s, %s, %s, %s, %s)" % (ctx._parseExpr(player), ctx._parseExpr(direction), ctx._parseExpr(speed), ctx._parseExpr(relative), ctx._parseExpr(motion))
+    return _call(ctx, "Apply Impulse", player, direction, speed, relative, motion)
 
 def bigMessage(ctx, visibleTo, header):
-    return "Big Message(%s, %s)" % (ctx._parseExpr(visibleTo), ctx._parseExpr(header))
+    return _call(ctx, "Big Message", visibleTo, header)
 
 #======================
 #VALUES
@@ -67,78 +72,78 @@ def bigMessage(ctx, visibleTo, header):
 #-----------
 
 def abs(ctx, x):
-    return "Absolute Value(%s)" % ctx._parseExpr(x)
+    return _call(ctx, "Absolute Value", x)
 
 #-----------
 #Datatypes
 #-----------
 
 def vector(ctx, x, y, z):
-    return "Vector(%s, %s, %s)" % (ctx._parseExpr(x), ctx._parseExpr(y), ctx._parseExpr(z))
+    return _call(ctx, "Vector", x, y, z)
 
 def hero(ctx, h):
-    return "Hero(%s)" % ctx._parseExpr(h)
+    return _call(ctx, "Hero", h)
 
 def backward(ctx):
-    return "Backward"
+    return _ir.Value("Backward")
 
 def team(ctx, team):
-    return "Team(%s)" % ctx._parseExpr(team)
+    return _call(ctx, "Team", team)
 
 def victim(ctx):
-    return "Victim"
+    return _ir.Value("Victim")
 
 def attacker(ctx):
-    return "Attacker"
+    return _ir.Value("Attacker")
 
 #-----------
 #Other
 #-----------
 
 def heroOf(ctx, player):
-    return "HeroOf(%s)" % ctx._parseExpr(player)
+    return _call(ctx, "HeroOf", player)
 
 def isButtonHeld(ctx, player, button):
-    return "Is Button Held(%s, %s)" % (ctx._parseExpr(player), ctx._parseExpr(button))
+    return _call(ctx, "Is Button Held", player, button)
 
 def allDeadPlayers(ctx, team):
-    return "All Dead Players(%s)" % ctx._parseExpr(team)
+    return _call(ctx, "All Dead Players", team)
 
 def allHeroes(ctx):
-    return "All Heroes()"
+    return _ir.Value("All Heroes", ())
 
 def allLivingPlayers(ctx, team):
-    return "All Living Players(%s)" % ctx._parseExpr(team)
+    return _call(ctx, "All Living Players", team)
 
 def allPlayers(ctx, team):
-    return "All Players(%s)" % ctx._parseExpr(team)
+    return _call(ctx, "All Players", team)
 
 def allPlayersNotOnObjective(ctx, team):
-    return "All Players Not On Objective(%s)" % ctx._parseExpr(team)
+    return _call(ctx, "All Players Not On Objective", team)
 
 def allPlayersOnObjective(ctx, team):
-    return "All Players On Objective(%s)" % ctx._parseExpr(team)
+    return _call(ctx, "All Players On Objective", team)
 
 def allowedHeroes(ctx, player):
-    return "Allowed Heroes(%s)" % ctx._parseExpr(player)
+    return _call(ctx, "Allowed Heroes", player)
 
 def altitudeOf(ctx, player):
-    return "Altitude Of(%s)" % ctx._parseExpr(player)
+    return _call(ctx, "Altitude Of", player)
 
 def angleDifference(ctx, value1, value2):
-    return "Angle Difference(%s, %s)" % (ctx._parseExpr(value1), ctx._parseExpr(value2))
+    return _call(ctx, "Angle Difference", value1, value2)
 
 def arrayContains(ctx, array, value):
-    return "Array Contains(%s, %s)" % (ctx._parseExpr(array), ctx._parseExpr(value))
+    return _call(ctx, "Array Contains", array, value)
 
 def arraySlice(ctx, array, start, count):
-    return "Array Slice(%s, %s, %s)" % (ctx._parseExpr(array), ctx._parseExpr(start), ctx._parseExpr(count))
+    return _call(ctx, "Array Slice", array, start, count)
 
 def closestPlayerTo(ctx, center, team):
-    return "Closest Player To(%s, %s)" % (ctx_parseExpr(center, team))
+    return _call(ctx, "Closest Player To", center, team)
 
 def countOf(ctx, array):
-    return "Count Of(%s)" % ctx._parseExpr(array)
+    return _call(ctx, "Count Of", array)
 
 #======================
 #BUILTIN PYTHON FUNCTIONS
@@ -155,7 +160,7 @@ def countOf(ctx, array):
 def range(ctx, *args):
 
     #Bit dodgy this, may want to revise
-    return ctx._create_1d_array(_range(*map(lambda x: int(ctx._parseExpr(x)), args)))
+    return ctx._create_1d_array(_range(*map(lambda x: int(ctx._parseConstant(x)), args)))
 
 len = countOf
 
@@ -166,27 +171,27 @@ len = countOf
 #I/O
 def input(ctx, var, player=None):
 
-    var = ctx._parseExpr(var)
+    var = ctx._parseConstant(var)
     if var in ctx.used_vars:
         raise RuntimeError("Use of external variable %s prohibited: Variable is already in use by the compiler." % var)
 
     if player is not None:
         player = ctx._parseExpr(player)
-        return "Player Variable(%s, %s)" % (player, var)
+        return _ir.Variable(var, player=player)
 
-    return "Global Variable(%s)" % var
+    return _ir.Variable(var)
 
 def output(ctx, value, var, player=None):
 
-    var = ctx._parseExpr(var)
+    var = ctx._parseConstant(var)
     if var in ctx.used_vars:
         raise RuntimeError("Use of external variable %s prohibited: Variable is already in use by the compiler." % var)
 
     if player is not None:
         player = ctx._parseExpr(player)
-        return "Set Player Variable(%s, %s, %s)" % (player, var, ctx._parseExpr(value))
+        return _ir.SetVariable(var, None, ctx._parseExpr(value), player)
 
-    return "Set Global Variable(%s, %s)" % (var, ctx._parseExpr(value))
+    return _ir.SetVariable(var, None, ctx._parseExpr(value))
 
 #Override standard variable I/O to raise an exception if used
 def setGlobalVariable(*args):
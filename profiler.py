@@ -0,0 +1,89 @@
+#Phase level profiling for the OverScript compiler
+#
+#The compiler reports the phases it goes through (parsing, rule generation,
+#string template matching, optimization passes, serialization...) to the
+#hooks registered using OverScriptCompiler.addProfileHook. The Profiler
+#defined here is such a hook, it keeps call counts and wall time for every
+#phase and a trace of all phases that can be viewed in chrome://tracing.
+
+#Copyright (c) 2019 fredi_68
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import collections
+import time
+
+#Totals recorded for a phase
+PhaseTotals = collections.namedtuple("PhaseTotals", ("name", "calls", "seconds"))
+
+class Profiler():
+
+    """
+    Profiling hook recording the phases of one or more compilations.
+
+    Phases may be nested, e.g. string template matching happens while a
+    rule is being parsed. Times are always inclusive of nested phases.
+    context is added to all trace events recorded, which allows telling
+    apart the phases of different files compiled by the same compiler.
+    """
+
+    def __init__(self):
+
+        self.calls = collections.Counter()
+        self.seconds = collections.Counter()
+        self.events = []
+        self.context = None
+        self.origin = time.perf_counter()
+
+    def __call__(self, phase, start, duration):
+
+        self.calls[phase] += 1
+        self.seconds[phase] += duration
+        self.events.append((phase, start, duration, self.context))
+
+    def totals(self):
+
+        """
+        Returns a list of PhaseTotals for every phase, most expensive first.
+        """
+
+        return sorted([PhaseTotals(phase, self.calls[phase], self.seconds[phase]) for phase in self.calls], key=lambda x: -x.seconds)
+
+    def trace(self):
+
+        """
+        Returns the recorded phases in the Trace Event Format
+        used by chrome://tracing, ready to be dumped as JSON.
+        Timestamps are in microseconds since the profiler was created.
+        """
+
+        events = []
+        for phase, start, duration, context in self.events:
+            event = {
+                "name": phase,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": duration * 1e6,
+                "pid": 0,
+                "tid": 0
+                }
+            if context is not None:
+                event["args"] = {"context": context}
+            events.append(event)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -0,0 +1,528 @@
+#This utility runs performance benchmarks for the OverScript compiler
+#and prints the results to stdout.
+#Run it from the root directory of the compiler, optionally passing the
+#names of the benchmarks to run (all benchmarks are run by default).
+
+#Copyright (c) 2019 fredi_68
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import argparse
+import ast
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import ir
+import workshop_index
+from string_parser import StringParser
+
+#Format strings as they typically appear in scripts, already lowercased
+#like the compiler does before handing them to the string parser.
+STRING_CORPUS = [
+    "{0} - {1}",
+    "score: {0}",
+    "round {0}",
+    "current hero: {0}",
+    "hello!",
+    "{0} vs {1}",
+    "current level: {0} / {1}",
+    "{0} m/s",
+    "control point: {0}%",
+    "{0}, {1}, and {2}",
+    "best {0}",
+    "current enemies: {0}",
+    "ability 1: {0} sec",
+    "round {0}: {1} - {2}",
+    "attack!!!",
+    "(attack)",
+    "level {0} -> level {1}",
+    "{0} -> {1} -> {2} -> {3}",
+    "{0} - {1} - {2}: {3} -> {4}",
+    ]
+STRING_PARAMS = [ir.Variable("A", i) for i in range(5)]
+
+class LegacyStringParser(StringParser):
+
+    """
+    String parser using the original template matching loop,
+    which builds and matches a regular expression for every
+    template on every call and formats its result as text.
+    Used as a reference for benchmarks.
+    """
+
+    def parse(self, s, params, depth=0):
+
+        final_string = ""
+
+        if not depth:
+            for template, phrase in self.us_words:
+                s = s.replace(phrase, template)
+
+        m = self.PARAM_ONLY_RE.fullmatch(s)
+        if m is not None:
+            return str(params[int(m.group(1))])
+
+        for template in self.words:
+            temp_re = "^%s$" % re.sub(self.PARAM_REPLACE_RE, "(.+)", re.escape(template))
+            self.logger.debug("Testing string template '%s' (-> RE template '%s')..." % (template, temp_re))
+
+            match = re.match(temp_re, s)
+            if match is not None:
+                try:
+                    self.logger.debug("Match found: %s" % template)
+                    string_args = ['"%s"' % template.replace("_", " ")]
+                    for group in match.groups():
+                        self.logger.debug("Parsing group '%s'..." % group)
+                        paramStr = re.fullmatch(self.PARAM_MATCH_RE, group)
+                        if paramStr:
+                            try:
+                                string_args.append(str(params[int(paramStr.group(1))]))
+                            except IndexError:
+                                raise TypeError("Not enough arguments to format string.")
+                        else:
+                            string_args.append(self.parse(group, params))
+
+                    string_args.extend(["null"] * (4 - len(string_args)))
+                    final_string += "String(%s)" % ", ".join(string_args)
+
+                    break
+                except ValueError as e:
+                    self.logger.debug("%s. Trying next template..." % str(e))
+                    continue
+
+        else:
+            raise ValueError("Can't match string '%s': No matching template found." % s)
+
+        return final_string
+
+def measure(func, repeat):
+
+    """
+    Call func repeat times and return the best time of a single call in seconds.
+    """
+
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def report(name, old, new):
+
+    print("    %-28s %10.3f ms %10.3f ms %8.1fx" % (name, old * 1000, new * 1000, old / new if new else float("inf")))
+
+def bench_string_parser(args):
+
+    """
+    Compare the legacy and the indexed string template matcher.
+    """
+
+    legacy = LegacyStringParser()
+    indexed = StringParser()
+
+    for s in STRING_CORPUS:
+        if legacy.parse(s, STRING_PARAMS) != str(indexed.parse(s, STRING_PARAMS)):
+            raise AssertionError("String parser output differs for '%s'" % s)
+
+    def run(parser):
+        def f():
+            for s in STRING_CORPUS:
+                parser.parse(s, STRING_PARAMS)
+        return f
+
+    print("String parser (%i strings, %i templates):" % (len(STRING_CORPUS), len(indexed.words)))
+    print("    %-28s %13s %13s %9s" % ("", "legacy", "indexed", "speedup"))
+    report("corpus", measure(run(legacy), args.repeat), measure(run(indexed), args.repeat))
+
+def bench_string_stress(args):
+
+    """
+    Compare the legacy and the memoizing string parser on long,
+    many-parameter strings which make the legacy parser backtrack.
+    """
+
+    legacy = LegacyStringParser()
+    memoized = StringParser()
+    params = [ir.Variable("A", i) for i in range(16)]
+
+    print("String parser stress test:")
+    print("    %-28s %13s %13s %9s" % ("", "legacy", "memoized", "speedup"))
+    for n in (3, 5, 7):
+        s = ", ".join(map("{%i}".__mod__, range(n))) + "!"
+        if legacy.parse(s, params) != str(memoized.parse(s, params)):
+            raise AssertionError("String parser output differs for '%s'" % s)
+        report("%i parameters" % n, measure(lambda: legacy.parse(s, params), args.repeat), measure(lambda: memoized.parse(s, params), args.repeat))
+
+def bench_startup(args):
+
+    """
+    Measure how long it takes to load the string template database,
+    with and without the prebuilt database next to strings.txt.
+    """
+
+    with tempfile.TemporaryDirectory() as d:
+        db_file = os.path.join(d, "strings.txt")
+        shutil.copyfile("res/strings.txt", db_file)
+
+        def cold():
+            re.purge()
+            StringParser(db_file, use_cache=False)
+
+        def warm():
+            re.purge()
+            StringParser(db_file)
+
+        StringParser(db_file) #build database
+        print("String template database startup:")
+        print("    %-28s %13s %13s %9s" % ("", "cold", "prebuilt", "speedup"))
+        report("StringParser()", measure(cold, args.repeat), measure(warm, args.repeat))
+
+def synthetic_workshop_json(count=600):
+
+    """
+    Create a document resembling workshop.json, for benchmarking
+    on machines which don't have the real file.
+    """
+
+    def function(kind, i):
+        args = [{"name": "Argument %i" % j, "description": "", "type": "Number"} for j in range(i % 5)]
+        return {"name": "%s Function Number %i" % (kind, i), "description": "", "args": args}
+
+    return {
+        "actions": [function("Action", i) for i in range(count // 2)],
+        "values": [function("Value", i) for i in range(count // 2)],
+        }
+
+def bench_workshop_index(args):
+
+    """
+    Measure how long it takes to load the workshop.json function index,
+    with and without the saved index next to workshop.json.
+    Uses res/workshop.json if it exists, a synthetic document otherwise.
+    """
+
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "workshop.json")
+        if os.path.exists(workshop_index.DEFAULT_PATH):
+            shutil.copyfile(workshop_index.DEFAULT_PATH, path)
+        else:
+            with open(path, "w") as f:
+                json.dump(synthetic_workshop_json(), f)
+
+        index = workshop_index.WorkshopIndex(path) #build index
+        print("Workshop function index (%i functions):" % len(index.functions))
+        print("    %-28s %13s %13s %9s" % ("", "cold", "warm", "speedup"))
+        report("WorkshopIndex()", measure(lambda: workshop_index.WorkshopIndex(path, use_cache=False), args.repeat), measure(lambda: workshop_index.WorkshopIndex(path), args.repeat))
+
+def generate_script(rules=200):
+
+    """
+    Generate a large OverScript file exercising the common statement
+    and expression types.
+    """
+
+    lines = []
+    for i in range(rules):
+        lines.append('@event("%s")' % ("global" if i % 2 else "player"))
+        lines.append("def rule_%i():" % i)
+        lines.append("    a = %i" % i)
+        lines.append("    b = a * 2 + (a - 1) / 3")
+        lines.append("    c = [a, b, a + b]")
+        lines.append("    d = c[0] + c[1] * c[2]")
+        lines.append("    player.speed = abs(b - a) % 5")
+        lines.append("    if a + b > d * 2:")
+        lines.append("        e = vector(a, b, 0)")
+        lines.append("    else:")
+        lines.append("        e = vector(0, 1, 0)")
+        lines.append("    while a < 10:")
+        lines.append("        a += 1")
+        lines.append("        wait(0.1)")
+        lines.append("    for x in c:")
+        lines.append("        b = b + x * 2")
+        lines.append('    bigMessage(player, "{0} - {1}" << (a, b))')
+        lines.append("")
+    return "\n".join(lines)
+
+def bench_compile(args):
+
+    """
+    Measure compiler throughput on a large generated script.
+    """
+
+    import optimizer
+    from compiler import OverScriptCompiler, BINARY_OPERATORS
+
+    class LegacyDispatchCompiler(OverScriptCompiler):
+
+        """
+        Compiler dispatching AST nodes through isinstance chains
+        instead of handler tables.
+        Used as a reference for benchmarks.
+        """
+
+        def _parseBody(self, node):
+
+            if isinstance(node, ast.Assign):
+                self._parseAssign(node)
+            elif isinstance(node, ast.While):
+                self._parseWhile(node)
+            elif isinstance(node, ast.If):
+                self._parseIf(node)
+            elif isinstance(node, ast.Expr):
+                self._parseExprStatement(node)
+            elif isinstance(node, ast.AugAssign):
+                self._parseAugAssign(node)
+            elif isinstance(node, ast.For):
+                self._parseFor(node)
+            elif isinstance(node, ast.Return):
+                self._parseReturn(node)
+            else:
+                raise RuntimeError("Unsupported node %s" % str(node))
+
+        def _parseExpr(self, node, parse_array=True):
+
+            if isinstance(node, ast.Call):
+                value = self._parseCall(node)
+            elif isinstance(node, ast.Name):
+                value = self._parseName(node)
+            elif isinstance(node, ast.Subscript):
+                value = self._parseSubscript(node)
+            elif isinstance(node, (ast.List, ast.Tuple)):
+                return self._parseArray(node, parse_array)
+            elif isinstance(node, ast.BinOp):
+                value = self._parseBinaryOp(node)
+            elif isinstance(node, ast.Compare):
+                value = self._parseCompare(node)
+            elif isinstance(node, ast.Attribute):
+                value = self._parseAttribute(node)
+            else:
+                return self._parseLiteral(node)
+            return optimizer.foldValue(value)
+
+        def _parseBinaryOp(self, node):
+
+            op = node.op
+            if isinstance(op, ast.LShift):
+                return self._parseStringFormat(node)
+            for cls in (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.Mod, ast.Pow, ast.And, ast.Or):
+                if isinstance(op, cls):
+                    break
+            else:
+                raise RuntimeError("Unrecognized binary operator '%s'" % str(node.op))
+            left = self._parseExpr(node.left)
+            right = self._parseExpr(node.right)
+            return ir.Value(BINARY_OPERATORS[cls], (left, right))
+
+    source = generate_script()
+    results = []
+    for cls in (LegacyDispatchCompiler, OverScriptCompiler):
+        compiler = cls()
+        results.append(compiler.compile(source)) #also loads databases
+    if results[0] != results[1]:
+        raise AssertionError("Compiler output differs between dispatch methods")
+
+    def run(cls):
+        compiler = cls()
+        compiler.compile(source)
+        return measure(lambda: compiler.compile(source), args.repeat)
+
+    old = run(LegacyDispatchCompiler)
+    new = run(OverScriptCompiler)
+    lines = source.count("\n") + 1
+    print("Compiler throughput (%i lines):" % lines)
+    print("    %-28s %13s %13s %9s" % ("", "isinstance", "tables", "speedup"))
+    report("compile", old, new)
+    print("    %-28s %10.0f lines/s" % ("throughput", lines / new))
+
+def nested_loops(depth):
+
+    """
+    Generate a rule summing products over depth nested for loops.
+    """
+
+    lines = ['@event("global")', "def nested_%i():" % depth, "    l = [1, 2, 3]", "    sum = 0"]
+    for i in range(depth):
+        lines.append("    " * (i + 1) + "for x%i in l:" % i)
+    lines.append("    " * (depth + 1) + "sum += " + " * ".join("x%i" % i for i in range(depth)))
+    return "\n".join(lines)
+
+def loop_iteration_cost(rule):
+
+    """
+    Returns the number of actions and elements executed by one
+    iteration of the innermost loop of rule, whose body
+    must not contain any branches.
+    """
+
+    actions = rule.actions
+    end = next(i for i, action in enumerate(actions) if action.__class__ is not ir.Label and action.name in ("Loop", "End"))
+    if actions[end].name == "End":
+        start = max(i for i in range(end) if actions[i].__class__ is not ir.Label and actions[i].name == "While")
+        executed = actions[start:end + 1]
+    else:
+        #the loop branch of the innermost loop is the last one set before its Loop action,
+        #each iteration runs the actions at the start of the rule and then skips to it
+        head = [action.value.label for action in actions[:end] if isinstance(action, ir.SetVariable) and action.var == "B" and isinstance(action.value, ir.Offset)][-1]
+        entry = actions.index(rule.entry)
+        executed = actions[:entry] + actions[actions.index(head):end + 1]
+    executed = [action for action in executed if action.__class__ is not ir.Label]
+    return len(executed), sum(action.elements() for action in executed)
+
+def bench_loop_counters(args):
+
+    """
+    Compare the cost of a loop iteration using the legacy loop iteration
+    stack and the statically assigned loop iteration counters.
+    """
+
+    from compiler import OverScriptCompiler
+
+    class LegacyLoopCompiler(OverScriptCompiler):
+
+        """
+        Compiler keeping loop iterations on a stack per rule, which is
+        rebuilt whenever a loop starts, ends or advances.
+        Used as a reference for benchmarks.
+        """
+
+        def _loopIterationStack(self):
+
+            return ir.Variable(self.VS_LIS, self.ruleID(), self.registerPlayer())
+
+        def _loopIterationPop(self):
+
+            stack = self._loopIterationStack()
+            count = ir.Value("Subtract", (ir.Value("Count Of", (stack,)), ir.Literal(1)))
+            return ir.Value("Array Slice", (stack, ir.Literal(0), count))
+
+        def setLoopIteration(self, iteration):
+
+            value = ir.Value("Append To Array", (self._loopIterationPop(), iteration))
+            self.addAction(ir.SetVariable(self.VS_LIS, self.ruleID(), value, self.registerPlayer()))
+
+        def incrementLoopIteration(self):
+
+            self.setLoopIteration(ir.Value("Add", (self.getLoopIteration(), ir.Literal(1))))
+
+        def getLoopIteration(self):
+
+            return ir.Value("Last Of", (self._loopIterationStack(),))
+
+        def pushLoopIteration(self):
+
+            value = ir.Value("Append To Array", (self._loopIterationStack(), ir.Literal(0)))
+            self.addAction(ir.SetVariable(self.VS_LIS, self.ruleID(), value, self.registerPlayer()))
+
+        def pullLoopIteration(self):
+
+            self.addAction(ir.SetVariable(self.VS_LIS, self.ruleID(), self._loopIterationPop(), self.registerPlayer()))
+
+    with open("tests/testArrays.os") as f:
+        scripts = [("testArrays.os", f.read())]
+    scripts.extend(("depth %i" % depth, nested_loops(depth)) for depth in (1, 2, 3, 4))
+
+    print("Innermost loop iteration (actions / elements):")
+    print("    %-28s %13s %13s" % ("", "legacy", "counters"))
+    for native in (False, True):
+        for name, source in scripts:
+            results = []
+            for cls in (LegacyLoopCompiler, OverScriptCompiler):
+                compiler = cls(optimize=True, nativeLoops=native)
+                compiler.compile(source)
+                results.append("%5i / %5i" % loop_iteration_cost(compiler.rules[-1]))
+            print("    %-28s %13s %13s" % ("%s (%s)" % (name, "While" if native else "Loop"), *results))
+
+def table(shape, start=0):
+
+    """
+    Returns the source of a nested list literal of the given shape.
+    """
+
+    if not shape:
+        return str(start)
+    size = 1
+    for n in shape[1:]:
+        size *= n
+    return "[%s]" % ", ".join(table(shape[1:], start + i * size) for i in range(shape[0]))
+
+def bench_nested_arrays(args):
+
+    """
+    Compare the actions and elements used to assemble nested array literals
+    on the legacy array assembly stack and as nested values.
+    """
+
+    from compiler import OverScriptCompiler, TOS
+
+    class LegacyArrayCompiler(OverScriptCompiler):
+
+        """
+        Compiler assembling all nested arrays on the array assembly stack,
+        escaping every element on its own.
+        Used as a reference for benchmarks.
+        """
+
+        def _create_nd_array(self, l):
+
+            self._array_build(TOS(), l)
+            return ir.Value("Value In Array", (ir.Variable(self.VS_AAS, 0, self.registerPlayer()), ir.Literal(0)))
+
+    print("Nested array assembly (actions / elements):")
+    print("    %-28s %13s %13s" % ("", "legacy", "nested"))
+    for shape in ((2, 2), (4, 4), (8, 8), (2, 2, 2), (3, 3, 3), (4, 4, 4)):
+        source = '@event("global")\ndef tables():\n    t = %s\n    bigMessage(allPlayers("All"), t)\n' % table(shape)
+        results = []
+        for cls in (LegacyArrayCompiler, OverScriptCompiler):
+            compiler = cls(optimize=True)
+            compiler.compile(source)
+            actions = [action for rule in compiler.rules for action in rule.actions if action.__class__ is not ir.Label]
+            results.append("%5i / %5i" % (len(actions), sum(action.elements() for action in actions)))
+        print("    %-28s %13s %13s" % ("x".join(map(str, shape)), *results))
+
+BENCHMARKS = {
+    "strings": bench_string_parser,
+    "strings-stress": bench_string_stress,
+    "startup": bench_startup,
+    "workshop": bench_workshop_index,
+    "compile": bench_compile,
+    "loops": bench_loop_counters,
+    "arrays": bench_nested_arrays,
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run OverScript compiler benchmarks")
+    parser.add_argument("-r", "--repeat", action="store", type=int, default=5, help="number of repetitions per measurement")
+    parser.add_argument("benchmark", nargs="*", help="benchmarks to run (%s)" % ", ".join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.benchmark:
+        if not name in BENCHMARKS:
+            parser.error("unknown benchmark '%s'" % name)
+
+    logging.basicConfig(level=logging.WARN)
+
+    for name in args.benchmark or BENCHMARKS:
+        BENCHMARKS[name](args)
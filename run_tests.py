@@ -1,6 +1,12 @@
 ﻿#This utility takes all files from the ./tests directory ending in .os (OverScript)
 #and compiles them into .ow (OverWatch workshop script) files which may be
 #imported into the Overwatch Workshop
+#
+#With --check, the compiled scripts are compared to the expected output
+#in ./tests/golden instead, and any differences are reported. Scripts
+#containing loops or utility functions are also checked with native loops
+#and subroutines.
+#--update replaces the expected output with the current compiler output.
 
 #Copyright (c) 2019 fredi_68
 
@@ -23,19 +29,77 @@
 #SOFTWARE.
 
 from compiler import OverScriptCompiler
+import argparse
+import difflib
 import pathlib
 import logging
+import sys
+
+GOLDEN_DIR = pathlib.Path("./tests/golden")
+#Scripts whose expected output is also checked with native loops and
+#subroutines, which is stored in <name>.native.ows
+NATIVE_TESTS = ("hover.os", "testArrays.os", "testFunctions.os", "testLoops.os", "testPeephole.os", "testReturn.os", "testUnroll.os")
+
+parser = argparse.ArgumentParser(description="Compile the OverScript test scripts")
+parser.add_argument("--check", action="store_true", help="compare the compiled scripts to the expected output")
+parser.add_argument("--update", action="store_true", help="replace the expected output with the compiled scripts")
+args = parser.parse_args()
 
 if __debug__:
     logging.basicConfig(level=logging.DEBUG)
 else:
     logging.basicConfig(level=logging.INFO)
 
+def compare(file, code, golden):
+
+    """
+    Compare the compiled script to the expected output in golden.
+    Returns True if they match.
+    """
+
+    if not golden.exists():
+        logging.error("No expected output for script '%s'." % str(file))
+        return False
+    with open(golden, "r") as f_golden:
+        expected = f_golden.read()
+    if code != expected:
+        diff = difflib.unified_diff(expected.splitlines(True), code.splitlines(True), str(golden), str(file))
+        sys.stdout.writelines(diff)
+        return False
+    return True
+
 logging.info("Compiling test scripts...")
-comp = OverScriptCompiler(parseUnknownFunctions=False, correctAccents=True)
-for file in pathlib.Path("./tests").iterdir():
+if args.check or args.update:
+    #the expected output must not depend on whether workshop.json is available
+    configurations = [
+        (OverScriptCompiler(parseUnknownFunctions=False, correctAccents=True, nativeLoops=False, subroutines=False), ".ows", None),
+        (OverScriptCompiler(parseUnknownFunctions=False, correctAccents=True, nativeLoops=True, subroutines=True), ".native.ows", NATIVE_TESTS)
+        ]
+else:
+    configurations = [(OverScriptCompiler(parseUnknownFunctions=False, correctAccents=True), ".ows", None)]
+
+failed = []
+for file in sorted(pathlib.Path("./tests").iterdir()):
     if file.suffix == ".os":
         logging.info("Compiling script '%s'..." % str(file))
         with open(file, "r") as f_in:
-            with open(file.with_suffix(".ows"), "w") as f_out:
-                f_out.write(comp.compile(f_in.read()))
\ No newline at end of file
+            source = f_in.read()
+        for comp, suffix, tests in configurations:
+            if tests is not None and not file.name in tests:
+                continue
+            code = comp.compile(source)
+            golden = GOLDEN_DIR / (file.stem + suffix)
+            if args.update:
+                GOLDEN_DIR.mkdir(exist_ok=True)
+                with open(golden, "w") as f_out:
+                    f_out.write(code)
+            elif args.check:
+                if not compare(file, code, golden):
+                    failed.append(golden)
+            else:
+                with open(file.with_suffix(suffix), "w") as f_out:
+                    f_out.write(code)
+
+if failed:
+    logging.error("Output differs for %i script(s): %s" % (len(failed), ", ".join(map(str, failed))))
+    sys.exit(1)
@@ -6,6 +6,95 @@
 
 import logging
 import re
+import collections
+import hashlib
+import io
+import os
+import pickle
+
+import ir
+
+class TemplateMatcher():
+
+    """
+    Matching engine for string templates.
+
+    Templates without parameters are looked up directly. For all other
+    templates, the literal text in front of the first parameter is stored
+    in a prefix trie and the literal text after the last parameter is stored
+    in a suffix trie. Walking both tries along the input string yields the
+    templates that can possibly match it, so the cost of finding candidates
+    depends on the length of the input and not on the number of templates.
+    """
+
+    def __init__(self, templates):
+
+        """
+        Create a new matcher.
+        templates should be a list of (template, prefix, suffix, has_params)
+        tuples. Candidates are reported as indices into this list, in
+        ascending order.
+        """
+
+        self.literals = {}
+        self.prefixes = {}
+        self.suffixes = {}
+
+        for i, (template, prefix, suffix, has_params) in enumerate(templates):
+            if not has_params:
+                self.literals.setdefault(template, []).append(i)
+                continue
+            self._insert(self.prefixes, prefix, i)
+            self._insert(self.suffixes, suffix[::-1], i)
+
+    @staticmethod
+    def _insert(trie, key, index):
+
+        node = trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node.setdefault(None, []).append(index)
+
+    @staticmethod
+    def _walk(trie, s, found):
+
+        """
+        Walk down the trie along s, adding all indices stored
+        in the visited nodes to the set found.
+        """
+
+        node = trie
+        if None in node:
+            found.update(node[None])
+        for char in s:
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                found.update(node[None])
+
+    def candidates(self, s):
+
+        """
+        Return the indices of all templates which may match s
+        in ascending order.
+        """
+
+        #a trailing newline is allowed to follow the template
+        #since template patterns are anchored using $
+        stripped = s[:-1] if s.endswith("\n") else s
+
+        prefixed = set()
+        self._walk(self.prefixes, s, prefixed)
+        suffixed = set()
+        self._walk(self.suffixes, reversed(s), suffixed)
+        if stripped is not s:
+            self._walk(self.suffixes, reversed(stripped), suffixed)
+
+        found = prefixed & suffixed
+        found.update(self.literals.get(s, ()))
+        found.update(self.literals.get(stripped, ()))
+        return sorted(found)
 
 class StringParser():
 
@@ -13,13 +102,32 @@ class StringParser():
     PARAM_REPLACE_RE = re.compile("(\\\\{[0-9]+?\\\\})")
     PARAM_MATCH_RE = re.compile("^\\{([0-9]+?)\\}")
     PARAM_ONLY_RE = re.compile("^\\{([0-9]+?)\\}$")
+    PARAM_FIND_RE = re.compile("\\{[0-9]+?\\}")
+
+    #Maximum number of parameterless substrings whose results are kept across parse() calls
+    LITERAL_CACHE_SIZE = 1024
+    #Bump this whenever the layout of the template database changes
+    CACHE_VERSION = 2
+    CACHE_SUFFIX = ".cache"
 
     logger = logging.getLogger("OS.StringParser")
 
-    def __init__(self, db_file="res/strings.txt"):
+    def __init__(self, db_file="res/strings.txt", use_cache=True):
+
+        """
+        Create a new string parser.
+        db_file is the path of the template list to load, if any.
+        If use_cache is True, the sorted and indexed template list is
+        saved next to db_file and reused as long as db_file doesn't change.
+        """
         
         self.words = []
         self.us_words = []
+        self.templates = []
+        self.matcher = TemplateMatcher(())
+        self.literal_cache = collections.OrderedDict()
+        self.patterns = {}
+        self.use_cache = use_cache
         if db_file:
             self.loadWords(db_file)
 
@@ -30,13 +138,71 @@ class StringParser():
         """
 
         with open(path, "r") as f:
-            for line in f.readlines():
-                if line.startswith("//"):
-                    continue
-                self.words.append(line.strip("\n").lower())
+            text = f.read()
+
+        #The template database can only be reused if it replaces the entire word list
+        use_cache = self.use_cache and not self.words
+        cache_path = os.path.splitext(path)[0] + self.CACHE_SUFFIX
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        if use_cache and self._loadCache(cache_path, digest):
+            return
+
+        for line in io.StringIO(text):
+            if line.startswith("//"):
+                continue
+            self.words.append(line.strip("\n").lower())
 
         self.sort()
 
+        if use_cache:
+            self._saveCache(cache_path, digest)
+
+    def _loadCache(self, path, digest):
+
+        """
+        Load the template database from path.
+        Returns False if there is no database or if it was built
+        from a different source file.
+        """
+
+        try:
+            with open(path, "rb") as f:
+                version, source_digest, state = pickle.loads(f.read())
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, ImportError, AttributeError):
+            return False
+
+        if version != self.CACHE_VERSION or source_digest != digest:
+            self.logger.debug("Template database '%s' is out of date.", path)
+            return False
+
+        self.words, self.us_words, self.templates, self.matcher = state
+        self.literal_cache.clear()
+        self.patterns.clear()
+        self.logger.debug("Loaded template database '%s'.", path)
+        return True
+
+    def _saveCache(self, path, digest):
+
+        """
+        Save the template database to path.
+        Failing to write the database is not an error,
+        it will simply be rebuilt next time.
+        """
+
+        state = (self.words, self.us_words, self.templates, self.matcher)
+        data = pickle.dumps((self.CACHE_VERSION, digest, state), pickle.HIGHEST_PROTOCOL)
+        temp_path = "%s.%i.tmp" % (path, os.getpid())
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            self.logger.debug("Unable to write template database '%s': %s", path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
     def sort(self):
 
         """
@@ -53,27 +219,21 @@ class StringParser():
                 j = i.replace("_", " ")
                 self.us_words.append((i, j))
 
+        plain = []
+        hasSymbol = []
         hasParam = []
-        for i in self.words[:]:
-            if "{0}" in i:
-                hasParam.append(i)
-                self.words.remove(i)
-
         hasParamAndSymbol = []
-        for i in hasParam[:]:
-            for char in self.SYMBOLS:
-                if char in i:
+        for i in self.words:
+            symbol = any(char in i for char in self.SYMBOLS)
+            if "{0}" in i:
+                if symbol:
                     hasParamAndSymbol.append(i)
-                    hasParam.remove(i)
-                    break
-
-        hasSymbol = []
-        for i in self.words[:]:
-            for char in self.SYMBOLS:
-                if char in i:
-                    hasSymbol.append(i)
-                    self.words.remove(i)
-                    break
+                else:
+                    hasParam.append(i)
+            elif symbol:
+                hasSymbol.append(i)
+            else:
+                plain.append(i)
 
         #Sorting key function
         def f(x):
@@ -82,14 +242,52 @@ class StringParser():
         hasParam.sort(key=f)
         hasParamAndSymbol.sort(key=f)
         hasSymbol.sort(key=f)
-        self.words.sort(key=f)
+        plain.sort(key=f)
 
+        self.words[:] = plain
         self.words.extend(hasSymbol)
         self.words.extend(hasParam)
         self.words.extend(hasParamAndSymbol)
 
         self.words.reverse()
 
+        self._buildIndex()
+
+    def _buildIndex(self):
+
+        """
+        Precompile all templates into match entries.
+
+        Each entry holds the regular expression for the template and the
+        minimum length of a matching string. Patterns are only compiled
+        once a template is first tested. Entries are stored in the
+        same order as self.words, the literal parts of the templates are
+        indexed by a TemplateMatcher.
+        """
+
+        self.templates = []
+        keys = []
+        for template in self.words:
+            params = list(self.PARAM_FIND_RE.finditer(template))
+            if params:
+                prefix = template[:params[0].start()]
+                suffix = template[params[-1].end():]
+                temp_re = "^%s$" % re.sub(self.PARAM_REPLACE_RE, "(.+)", re.escape(template))
+            else:
+                #literal template, no need for a pattern
+                prefix = template
+                suffix = ""
+                temp_re = None
+            min_length = len(prefix) + len(suffix) + len(params)
+            #TODO: Temporary fix
+            head = ir.Literal('"%s"' % template.replace("_", " "))
+            self.templates.append((template, temp_re, min_length, head))
+            keys.append((template, prefix, suffix, bool(params)))
+
+        self.matcher = TemplateMatcher(keys)
+        self.literal_cache.clear()
+        self.patterns.clear()
+
     def parse(self, s, params, depth=0):
 
         """
@@ -105,59 +303,103 @@ class StringParser():
         items are silently dropped.
         If params contains less items than s has parameters, TypeError is raised.
 
-        The returned value will be a string consisting of one or multiple calls
+        params should be a sequence of IR nodes.
+        The returned value will be an IR node consisting of one or multiple calls
         to the String() OWW function.
         """
 
-        final_string = ""
-
         #TODO: temporary fix
         if not depth:
             for template, phrase in self.us_words:
                 s = s.replace(phrase, template)
 
+        #results for every substring parsed during this call.
+        #Each substring only has to be decomposed once, no matter how
+        #many templates end up trying to match it.
+        return self._parse(s, params, {})
+
+    def _parse(self, s, params, memo):
+
+        """
+        Parse s using the memo table of the current parse() call.
+
+        Results for substrings without parameters don't depend on params,
+        so they are additionally kept in a bounded LRU cache shared by all
+        calls. Failed matches are cached as well.
+        """
+
+        if s in memo:
+            result = memo[s]
+        else:
+            literal = self.PARAM_FIND_RE.search(s) is None
+            if literal and s in self.literal_cache:
+                self.literal_cache.move_to_end(s)
+                result = self.literal_cache[s]
+            else:
+                try:
+                    result = self._match(s, params, memo)
+                except ValueError as e:
+                    result = e
+                if literal:
+                    self.literal_cache[s] = result
+                    if len(self.literal_cache) > self.LITERAL_CACHE_SIZE:
+                        self.literal_cache.popitem(last=False)
+            memo[s] = result
+
+        if isinstance(result, ValueError):
+            raise ValueError(*result.args)
+        return result
+
+    def _match(self, s, params, memo):
+
+        """
+        Find the first template matching s and build its String() value.
+        """
+
         #special case for when the string passed to the parse() method
         #is literally just "{n}"
         m = self.PARAM_ONLY_RE.fullmatch(s)
         if m is not None:
             return params[int(m.group(1))]
 
-        for template in self.words:
-            temp_re = "^%s$" % re.sub(self.PARAM_REPLACE_RE, "(.+)", re.escape(template))
-            self.logger.debug("Testing string template '%s' (-> RE template '%s')..." % (template, temp_re))
+        length = len(s)
 
-            match = re.match(temp_re, s)
-            if match is not None:
-                try:
-                    self.logger.debug("Match found: %s" % template)
-
-                    #TODO: Temporary fix
-                    #string_args = ['"%s"' % template]
-                    string_args = ['"%s"' % template.replace("_", " ")]
-                    #check parameters
-                    for group in match.groups():
-                        #is parameter formatted?
-                        self.logger.debug("Parsing group '%s'..." % group)
-                        paramStr = re.fullmatch(self.PARAM_MATCH_RE, group)
-                        if paramStr:
-                            #substitute parameter
-                            try:
-                                string_args.append(params[int(paramStr.group(1))])
-                            except IndexError:
-                                raise TypeError("Not enough arguments to format string.")
-                        else:
-                            #keep parsing
-                            string_args.append(self.parse(group, params))
-                
-                    string_args.extend(["null"] * (4 - len(string_args)))
-                    final_string += "String(%s)" % ", ".join(string_args)
-
-                    break
-                except ValueError as e:
-                    self.logger.debug("%s. Trying next template..." % str(e))
+        for i in self.matcher.candidates(s):
+            template, temp_re, min_length, head = self.templates[i]
+            if temp_re is None:
+                match = None
+            else:
+                if length < min_length:
                     continue
-
-        else:
-            raise ValueError("Can't match string '%s': No matching template found." % s)
-
-        return final_string
+                pattern = self.patterns.get(i)
+                if pattern is None:
+                    pattern = self.patterns[i] = re.compile(temp_re)
+                match = pattern.match(s)
+                if match is None:
+                    continue
+            try:
+                self.logger.debug("Match found: %s", template)
+
+                string_args = [head]
+                #check parameters
+                for group in (match.groups() if match is not None else ()):
+                    #is parameter formatted?
+                    self.logger.debug("Parsing group '%s'...", group)
+                    paramStr = re.fullmatch(self.PARAM_MATCH_RE, group)
+                    if paramStr:
+                        #substitute parameter
+                        try:
+                            string_args.append(params[int(paramStr.group(1))])
+                        except IndexError:
+                            raise TypeError("Not enough arguments to format string.")
+                    else:
+                        #keep parsing
+                        string_args.append(self._parse(group, params, memo))
+            
+                string_args.extend([ir.NULL] * (4 - len(string_args)))
+                return ir.Value("String", tuple(string_args))
+            except ValueError as e:
+                self.logger.debug("%s. Trying next template...", e)
+                continue
+
+        raise ValueError("Can't match string '%s': No matching template found." % s)
@@ -0,0 +1,172 @@
+#Function index for arxenix's workshop.json
+#
+#Resolves lowerCamelCase function names used in OverScript to the canonical
+#names and signatures of workshop actions and values. Parsing the JSON
+#documentation is comparatively slow, so the index is saved next to the JSON
+#file and only rebuilt when the file changes. Indices are loaded on demand and
+#shared by all compiler instances in the same process.
+
+#Copyright (c) 2019 fredi_68
+
+#Permission is hereby granted, free of charge, to any person obtaining a copy
+#of this software and associated documentation files (the "Software"), to deal
+#in the Software without restriction, including without limitation the rights
+#to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+#copies of the Software, and to permit persons to whom the Software is
+#furnished to do so, subject to the following conditions:
+
+#The above copyright notice and this permission notice shall be included in all
+#copies or substantial portions of the Software.
+
+#THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+#IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+#FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+#AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+#LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+#OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+#SOFTWARE.
+
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+DEFAULT_PATH = "res/workshop.json"
+
+logger = logging.getLogger("OS.WorkshopIndex")
+
+def camelCase(x):
+
+    """
+    Convert a workshop function name to the lowerCamelCase name used in OverScript.
+    """
+
+    words = x.split(" ")
+    if len(words) < 2:
+        return words[0].lower()
+    return "".join((words[0].lower(), *map(str.title, words[1:])))
+
+class WorkshopIndex():
+
+    """
+    Index of all actions and values documented in workshop.json.
+
+    functions maps the lowerCamelCase name of each function to a tuple
+    (canonical name, argument count, argument types).
+    """
+
+    #Bump this whenever the layout of the index changes
+    CACHE_VERSION = 1
+    CACHE_SUFFIX = ".cache"
+
+    def __init__(self, path=DEFAULT_PATH, use_cache=True):
+
+        """
+        Load the index for the workshop.json file at path.
+        If use_cache is True, the index is saved next to path and reused
+        as long as the JSON file doesn't change.
+        Raises OSError if path can't be read.
+        """
+
+        self.path = path
+        self.functions = {}
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        cache_path = os.path.splitext(path)[0] + self.CACHE_SUFFIX
+        digest = hashlib.sha1(data).hexdigest()
+        if use_cache and self._loadCache(cache_path, digest):
+            return
+
+        self._build(json.loads(data))
+        if use_cache:
+            self._saveCache(cache_path, digest)
+
+    def __contains__(self, name):
+
+        return name in self.functions
+
+    def __getitem__(self, name):
+
+        return self.functions[name]
+
+    def _build(self, d):
+
+        for action in d["actions"]:
+            self._add(action)
+
+        for value in d["values"]:
+            self._add(value)
+
+    def _add(self, function):
+
+        args = function["args"]
+        types = tuple(arg.get("type") for arg in args)
+        self.functions[camelCase(function["name"])] = (function["name"].title(), len(args), types)
+
+    def _loadCache(self, path, digest):
+
+        """
+        Load the index from path.
+        Returns False if there is no index or if it was built
+        from a different JSON file.
+        """
+
+        try:
+            with open(path, "rb") as f:
+                version, source_digest, functions = pickle.loads(f.read())
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError):
+            return False
+
+        if version != self.CACHE_VERSION or source_digest != digest:
+            logger.debug("Workshop index '%s' is out of date.", path)
+            return False
+
+        self.functions = functions
+        logger.debug("Loaded workshop index '%s'.", path)
+        return True
+
+    def _saveCache(self, path, digest):
+
+        """
+        Save the index to path.
+        Failing to write the index is not an error,
+        it will simply be rebuilt next time.
+        """
+
+        data = pickle.dumps((self.CACHE_VERSION, digest, self.functions), pickle.HIGHEST_PROTOCOL)
+        temp_path = "%s.%i.tmp" % (path, os.getpid())
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except OSError as e:
+            logger.debug("Unable to write workshop index '%s': %s", path, e)
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+
+#Indices loaded by this process, by path.
+#Paths that couldn't be loaded aren't remembered, since the
+#file may still appear while a long running process (--watch) is active.
+_indices = {}
+
+def getIndex(path=DEFAULT_PATH):
+
+    """
+    Return the shared index for the workshop.json file at path,
+    loading it on first use. Returns None if the file isn't available.
+    """
+
+    path = os.path.abspath(path)
+    if not path in _indices:
+        logger.debug("Trying to load workshop.json...")
+        try:
+            _indices[path] = WorkshopIndex(path)
+        except OSError:
+            logger.debug("workshop.json not found, WSJSON not available")
+            return None
+    return _indices[path]